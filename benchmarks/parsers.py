@@ -0,0 +1,144 @@
+"""Micro-benchmark of the page parsers.
+
+Times the parse_* functions of studip.parsers on the pages in benchmarks/fixtures and reports
+their throughput in pages and megabytes per second, along with the peak memory allocated while
+parsing a page:
+
+    $ python3 -m benchmarks.parsers --output parsers.json
+
+The fixtures were generated from the markup of the stand-in server in studip.mockserver, wrapped
+in a page frame with navigation and scripts like that of Stud.IP 3.5; they are not saved from a
+real server. They are the course overview (my_courses.html), the expanded file listing of a
+course with 40 files, 8 of them collapsed (folder.html), and the details of a single file
+(file_details.html). The file listing is additionally scaled up to thousands of files by
+repeating the files between its <!-- files --> markers. --fixtures reads pages of the same names
+from another directory instead, e.g. ones saved from a recording of a real server.
+"""
+
+import sys, os, re, json, time, hashlib, tracemalloc, argparse
+
+from studip.parsers import parse_semester_list, parse_course_list, parse_file_list, \
+        parse_file_listing, parse_file_details
+
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "fixtures")
+
+FILE_DIV_RE = re.compile(r'<div id="file_([0-9a-f]{32})_0">')
+
+COURSE_ID = "0" * 32
+
+
+def read_fixture(fixtures_dir, name):
+    with open(os.path.join(fixtures_dir, name), "r", encoding="utf-8") as file:
+        return file.read()
+
+
+def scale_file_listing(page, n_files):
+    """Returns the listing page with n_files files, made by repeating the files on the page
+    under new ids."""
+    start = page.index("<!-- files -->")
+    end = page.index("<!-- /files -->")
+    files = page[start:end]
+
+    templates = []
+    positions = [ match.start() for match in FILE_DIV_RE.finditer(files) ] + [ len(files) ]
+    for begin, end_of_div in zip(positions, positions[1:]):
+        div = files[begin:end_of_div]
+        templates.append((FILE_DIV_RE.match(div).group(1), div))
+
+    divs = []
+    for i in range(n_files):
+        file_id, div = templates[i % len(templates)]
+        new_id = hashlib.md5("file {}".format(i).encode()).hexdigest()
+        divs.append(div.replace(file_id, new_id))
+    return page[:start] + "<!-- files -->\n" + "".join(divs) + page[end:]
+
+
+def create_cases(fixtures_dir, sizes):
+    """Lists (name, function, page) for every benchmark, function taking the page."""
+    overview = read_fixture(fixtures_dir, "my_courses.html")
+    listing = read_fixture(fixtures_dir, "folder.html")
+    details = read_fixture(fixtures_dir, "file_details.html")
+
+    cases = [
+        ("semester_list", parse_semester_list, overview),
+        ("course_list", parse_course_list, overview),
+        ("file_details", lambda page: parse_file_details(COURSE_ID, page), details),
+        ("file_list", parse_file_list, listing),
+        ("file_listing", lambda page: parse_file_listing(COURSE_ID, page), listing),
+    ]
+    for n_files in sizes:
+        page = scale_file_listing(listing, n_files)
+        cases.append(("file_list/{}".format(n_files), parse_file_list, page))
+        cases.append(("file_listing/{}".format(n_files),
+                lambda page: parse_file_listing(COURSE_ID, page), page))
+    return cases
+
+
+def run_case(function, page, min_time):
+    """Parses page repeatedly for at least min_time seconds and returns its statistics."""
+    # A single run under tracemalloc, which slows down allocations considerably
+    tracemalloc.start()
+    function(page)
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    runs = 0
+    start = time.perf_counter()
+    while True:
+        function(page)
+        runs += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+
+    page_size = len(page.encode("utf-8"))
+    return {
+        "page_size": page_size,
+        "runs": runs,
+        "time_per_page": elapsed / runs,
+        "pages_per_second": runs / elapsed,
+        "mb_per_second": runs * page_size / elapsed / 2**20,
+        "peak_memory": peak_memory,
+    }
+
+
+def print_results(results, out=sys.stdout):
+    fmt = "{:20} {:>10} {:>10} {:>10} {:>10} {:>12}\n"
+    out.write(fmt.format("parser", "size [kB]", "time [ms]", "pages/s", "MB/s",
+            "memory [kB]"))
+    for name, stats in results.items():
+        out.write(fmt.format(name, "{:.1f}".format(stats["page_size"] / 1024),
+                "{:.3f}".format(stats["time_per_page"] * 1000),
+                "{:.1f}".format(stats["pages_per_second"]),
+                "{:.2f}".format(stats["mb_per_second"]),
+                "{:.1f}".format(stats["peak_memory"] / 1024)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Page parser micro-benchmark")
+    parser.add_argument("--fixtures", default=FIXTURES_DIR,
+            help="Directory with my_courses.html, folder.html and file_details.html")
+    parser.add_argument("--sizes", default="100,1000,5000",
+            help="Numbers of files to scale the file listing to (default 100,1000,5000)")
+    parser.add_argument("--min-time", type=float, default=1.0,
+            help="Minimum time spent on each benchmark in seconds (default 1)")
+    parser.add_argument("--filter", default="",
+            help="Only run benchmarks whose name contains this string")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    sizes = [ int(size) for size in args.sizes.split(",") if size ]
+    results = {}
+    for name, function, page in create_cases(args.fixtures, sizes):
+        if args.filter in name:
+            results[name] = run_case(function, page, args.min_time)
+
+    print_results(results)
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=4, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""Runs a single studip command and records the resources it used.
+
+Invoked by benchmarks.sync as
+
+    python3 -m benchmarks.phase <stats-file> <studip arguments>...
+
+The number of SQL statements executed and the peak resident set size of the process are written
+to <stats-file> as JSON when the command exits.
+"""
+
+import sys, json, atexit, resource
+
+from studip import application
+from studip.database import Database
+
+
+statements = 0
+
+def count_statement(sql):
+    global statements
+    statements += 1
+
+
+def trace_database():
+    """Counts every statement run on the connection of each Database, including those of
+    executemany() and executescript()."""
+    original_init = Database.__init__
+
+    def init(self, *args, **kwargs):
+        original_init(self, *args, **kwargs)
+        self.conn.set_trace_callback(count_statement)
+
+    Database.__init__ = init
+
+
+def write_stats(file_name):
+    # ru_maxrss is given in kilobytes on Linux
+    with open(file_name, "w") as file:
+        json.dump({
+            "queries": statements,
+            "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        }, file)
+
+
+def main():
+    stats_file = sys.argv[1]
+    sys.argv = [ "studip" ] + sys.argv[2:]
+    trace_database()
+    atexit.register(write_stats, stats_file)
+    application.main()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""End-to-end benchmark of the synchronization commands.
+
+Runs update, fetch, checkout and gc against a synthetic account served by the local stand-in
+server and a temporary sync directory, and reports for every phase the wall time, the number of
+HTTP requests, the number of SQL statements and the peak resident set size of the client:
+
+    $ python3 -m benchmarks.sync --dataset medium --output results.json
+
+Each command runs in its own process, so that memory usage is measured per phase. Passing
+--baseline compares the results to an earlier run and exits with status 1 if any phase got worse
+by more than the allowed threshold.
+"""
+
+import sys, os, json, time, tempfile, shutil, subprocess, argparse, platform
+
+from base64 import b64encode
+from ast import literal_eval
+
+from studip.config import Config
+from studip.util import encrypt_password
+from studip.mockserver import MockServer, MockAccount
+
+
+# Named data sets: (courses, files per course, folders per level, folder depth, file size)
+DATASETS = {
+    "tiny": (10, 10, 2, 1, 1024),
+    "small": (10, 100, 2, 2, 1024),
+    "medium": (100, 100, 3, 2, 1024),
+    "large": (1000, 100, 3, 2, 1024),
+}
+
+PHASES = [ "update", "fetch", "checkout", "gc" ]
+METRICS = [ "wall_time", "requests", "queries", "peak_rss" ]
+
+REPOSITORY_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+class SyncBenchmark:
+    """A sync directory with its own cache directory, set up to log into a stand-in server
+    without asking for credentials."""
+
+    def __init__(self, server, account, config={}):
+        self.server = server
+        self.base_dir = tempfile.mkdtemp(prefix="studip-benchmark-")
+        self.cache_dir = os.path.join(self.base_dir, "cache")
+        self.sync_dir = os.path.join(self.base_dir, "sync")
+        self.n_courses = len(account.courses)
+
+        secret = os.urandom(50)
+        os.makedirs(os.path.join(self.cache_dir, "studip"))
+        with open(os.path.join(self.cache_dir, "studip", "secret"), "wb") as file:
+            file.write(b64encode(secret) + b"\n")
+
+        os.makedirs(os.path.join(self.sync_dir, ".studip"))
+        conf = Config(os.path.join(self.sync_dir, ".studip", "studip.conf"))
+        conf["server", "studip_base"] = server.url
+        conf["server", "sso_base"] = server.url
+        conf["user", "user_name"] = account.user_name
+        conf["user", "password"] = encrypt_password(secret, account.password)
+        conf["user", "save_login"] = "yes"
+        for key, value in config.items():
+            conf[key] = value
+        conf.write()
+
+    def run_phase(self, command):
+        stats_file = os.path.join(self.base_dir, "stats.json")
+        # appdirs honors XDG_CACHE_HOME, which keeps the secret and history out of the home dir
+        env = dict(os.environ, XDG_CACHE_HOME=self.cache_dir, HOME=self.base_dir,
+                PYTHONPATH=REPOSITORY_DIR)
+
+        self.server.state.reset_stats()
+        start = time.perf_counter()
+        process = subprocess.run([ sys.executable, "-m", "benchmarks.phase", stats_file,
+                command, "-d", self.sync_dir ], env=env, cwd=REPOSITORY_DIR,
+                input="\n" * (self.n_courses + 1), stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE, universal_newlines=True)
+        wall_time = time.perf_counter() - start
+
+        if process.returncode != 0:
+            raise RuntimeError("studip {} failed with status {}:\n{}".format(command,
+                    process.returncode, process.stderr))
+
+        with open(stats_file, "r") as file:
+            stats = json.load(file)
+        stats["wall_time"] = wall_time
+        stats["requests"] = self.server.state.stats()["total_requests"]
+        return stats
+
+    def remove(self):
+        shutil.rmtree(self.base_dir, ignore_errors=True)
+
+
+def run_benchmark(args):
+    courses, files, folders, depth, file_size = DATASETS[args.dataset]
+    account = MockAccount(courses=courses, files=files, folders=folders, depth=depth,
+            file_size=file_size)
+    config = dict(((section, key), literal_eval(value)) for section, key, value in args.config)
+
+    results = {
+        "dataset": args.dataset,
+        "courses": courses,
+        "files": courses * files,
+        "latency": args.latency,
+        "config": dict(("{}/{}".format(*key), value) for key, value in config.items()),
+        "python": platform.python_version(),
+        "phases": {},
+    }
+
+    with MockServer(account, latency=args.latency) as server:
+        benchmark = SyncBenchmark(server, account, config)
+        try:
+            for phase in PHASES:
+                print("Running {} ...".format(phase), file=sys.stderr)
+                results["phases"][phase] = benchmark.run_phase(phase)
+        finally:
+            benchmark.remove()
+
+    return results
+
+
+def print_results(results, out=sys.stdout):
+    out.write("Data set {}: {} courses, {} files\n".format(results["dataset"],
+            results["courses"], results["files"]))
+    fmt = "{:10} {:>10} {:>10} {:>10} {:>14}\n"
+    out.write(fmt.format("phase", "time [s]", "requests", "queries", "peak RSS [MB]"))
+    for phase in PHASES:
+        stats = results["phases"][phase]
+        out.write(fmt.format(phase, "{:.2f}".format(stats["wall_time"]), stats["requests"],
+                stats["queries"], "{:.1f}".format(stats["peak_rss"] / 2**20)))
+
+
+def find_regressions(results, baseline, threshold, metrics):
+    """Lists every metric of a phase that exceeds its baseline value by more than threshold
+    (as a fraction of the baseline)."""
+    regressions = []
+    for phase, stats in results["phases"].items():
+        base_stats = baseline["phases"].get(phase, {})
+        for metric in metrics:
+            if metric not in base_stats:
+                continue
+            limit = base_stats[metric] * (1 + threshold)
+            if stats[metric] > limit:
+                regressions.append("{} {}: {} > {} (baseline {})".format(phase, metric,
+                        round(stats[metric], 3), round(limit, 3), round(base_stats[metric], 3)))
+    return regressions
+
+
+def parse_config_option(text):
+    try:
+        key, value = text.split("=", 1)
+        section, name = key.split("/", 1)
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected <section>/<key>=<value>")
+    return section, name, value
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end sync benchmark")
+    parser.add_argument("--dataset", choices=sorted(DATASETS), default="small")
+    parser.add_argument("--latency", type=float, default=0,
+            help="Simulated server delay per request in seconds")
+    parser.add_argument("--config", type=parse_config_option, action="append", default=[],
+            metavar="SECTION/KEY=VALUE", help="Set a studip.conf value, e.g. "
+            "connection/engine='asyncio'")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="Compare against the results in this JSON file")
+    parser.add_argument("--threshold", type=float, default=0.25,
+            help="Allowed relative regression per metric (default 0.25)")
+    parser.add_argument("--metrics", default=",".join(METRICS),
+            help="Metrics compared against the baseline (default: all)")
+    args = parser.parse_args()
+
+    results = run_benchmark(args)
+    print_results(results)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=4, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline, "r") as file:
+            baseline = json.load(file)
+        metrics = [ m for m in args.metrics.split(",") if m ]
+        regressions = find_regressions(results, baseline, args.threshold, metrics)
+        if regressions:
+            print("Regressions against {}:".format(args.baseline))
+            for regression in regressions:
+                print("  " + regression)
+            sys.exit(1)
+        print("No regressions against {}".format(args.baseline))
+
+
+if __name__ == "__main__":
+    main()
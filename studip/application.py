@@ -89,7 +89,26 @@ class Application:
         self.config = Config(self.config_file_name, {
                 ("server", "studip_base"): "https://studip.uni-passau.de",
                 ("server", "sso_base"): "https://sso.uni-passau.de",
-                ("connection", "update_concurrency"): 4
+                ("connection", "update_concurrency"): 4,
+                ("connection", "max_update_concurrency"): 16,
+                ("connection", "timeout"): 30.0,
+                ("connection", "retries"): 3,
+                ("connection", "retry_delay"): 1.0,
+                ("connection", "checkpoint_max_age"): 12 * 60 * 60,
+                ("connection", "fetch_concurrency"): 8,
+                ("connection", "fetch_order"): "none",
+                ("connection", "fetch_bandwidth"): 0,
+                ("connection", "zip_min_files"): 0,
+                ("connection", "fetch_commit_files"): 100,
+                ("connection", "fetch_commit_interval"): 5.0,
+                ("connection", "list_concurrency"): 1,
+                ("connection", "pipeline_depth"): 2,
+                ("connection", "parse_processes"): 0,
+                ("connection", "engine"): "threads",
+                ("database", "journal_mode"): "wal",
+                ("database", "synchronous"): "normal",
+                ("database", "cache_size"): 16384,
+                ("database", "mmap_size"): 64 * 2**20
             })
 
 
@@ -123,6 +142,21 @@ class Application:
         if ("user", "password") in self.config:
             password = decrypt_password(user_secret, self.config["user", "password"])
 
+        # The session cookies are as good as the password, so they are only kept if the user
+        # chose to save the full login
+        cookie_file_name = os.path.join(self.dot_dir, "cookies")
+        save_session = ("user", "save_login") in self.config \
+                and self.config["user", "save_login"].startswith("y")
+
+        # Recordings always start with a fresh login so that they can be replayed in any sync
+        # directory. A replay does not send the credentials anywhere and needs none.
+        record_dir = self.command_line.get("record_dir")
+        replay_dir = self.command_line.get("replay_dir")
+        use_cookies = not (record_dir or replay_dir)
+        if replay_dir:
+            user_name = user_name or ""
+            password = password or ""
+
         while True:
             if user_name is None:
                 user_name = input("Stud.IP user name: ")
@@ -134,7 +168,11 @@ class Application:
 
             try:
                 self.session = Session(self.config, self.database, user_name, password,
-                        self.sync_dir)
+                        self.sync_dir, cookie_file_name if save_session and use_cookies else None,
+                        record_dir, replay_dir, self.command_line.get("latency_scale", 1.0))
+            except IOError as e:
+                self.print_io_error("Unable to access recording in", record_dir or replay_dir, e)
+                raise ApplicationExit()
             except SessionError as e:
                 sys.stderr.write("\n{}\n".format(e))
                 if not isinstance(e, LoginError):
@@ -157,11 +195,34 @@ class Application:
                 self.config["user", "user_name"] = user_name
             if save_login == "y":
                 self.config["user", "password"] = encrypt_password(user_secret, password)
+            save_session = save_login == "y"
 
+        if not use_cookies:
+            return
 
-    def open_database(self):
         try:
-            self.database = Database(self.db_file_name)
+            if save_session:
+                self.session.save_cookies(cookie_file_name)
+            elif os.path.exists(cookie_file_name):
+                os.remove(cookie_file_name)
+        except Exception as e:
+            self.print_io_error("Unable to save session to", cookie_file_name, e)
+
+
+    def open_database(self, read_only=False):
+        profile = dict((key, self.config["database", key]) for key in [ "journal_mode",
+                "synchronous", "cache_size", "mmap_size" ])
+        if read_only:
+            # A read-only connection neither waits for nor holds up a running sync. If the
+            # database is missing or outdated, the regular connection below creates it.
+            try:
+                self.database = Database(self.db_file_name, profile, read_only=True)
+                return
+            except Exception:
+                pass
+
+        try:
+            self.database = Database(self.db_file_name, profile)
         except Exception as e:
             self.print_io_error("Unable to open database", self.db_file_name, e)
             raise ApplicationExit()
@@ -186,12 +247,16 @@ class Application:
 
 
     def clear_cache(self):
-        try:
-            os.remove(self.db_file_name)
-        except Exception as e:
-            if not (isinstance(e, IOError) and e.errno == ENOENT):
-                self.print_io_error("Unable to remove database file", self.db_file_name, e)
-                raise ApplicationExit()
+        # A journal or WAL left behind by a crash must not be paired with a new database, so
+        # these go first and the database is kept if one of them cannot be removed
+        for file_name in [ self.db_file_name + suffix for suffix in [ "-wal", "-shm",
+                "-journal" ] ] + [ self.db_file_name ]:
+            try:
+                os.remove(file_name)
+            except Exception as e:
+                if not (isinstance(e, IOError) and e.errno == ENOENT):
+                    self.print_io_error("Unable to remove database file", file_name, e)
+                    raise ApplicationExit()
 
         print("Cache cleared.")
 
@@ -388,6 +453,13 @@ class Application:
             "    help          Show this synopsis\n"
             "\nPossible global parameters:\n"
             "    -d <dir>      Sync directory, assuming most recent one if not given\n"
+            "    --record <dir>\n"
+            "                  Save all requests and responses to <dir>, without cookies\n"
+            "                  and credentials\n"
+            "    --replay <dir>\n"
+            "                  Answer requests from a recording instead of the server\n"
+            "    --latency-scale <factor>\n"
+            "                  Multiply the recorded latencies by <factor> when replaying\n"
             .format(sys.argv[0]))
 
 
@@ -409,12 +481,24 @@ class Application:
                 if args[i] == "-d" and i < len(args)-1:
                     self.command_line["sync_dir"] = args[i+1]
                     i += 1
+                elif args[i] in [ "--record", "--replay" ] and i < len(args)-1:
+                    self.command_line[args[i][2:] + "_dir"] = args[i+1]
+                    i += 1
+                elif args[i] == "--latency-scale" and i < len(args)-1:
+                    try:
+                        self.command_line["latency_scale"] = float(args[i+1])
+                    except ValueError:
+                        return False
+                    i += 1
                 else:
                     return False
             else:
                 plain.append(args[i])
             i += 1
 
+        if "record_dir" in self.command_line and "replay_dir" in self.command_line:
+            return False
+
         if not plain: return False
         op = plain[0]
         plain = plain[1:]
@@ -485,7 +569,9 @@ class Application:
         if op in [ "update", "fetch", "checkout", "sync", "view", "course" ]:
             self.configure()
             with self.config:
-                self.open_database()
+                read_only = op == "course" and self.command_line["course_op"] == "list" \
+                        or op == "view" and self.command_line["view_op"] == "show"
+                self.open_database(read_only)
 
                 if op in [ "update", "fetch", "sync" ]:
                     self.open_session()
@@ -0,0 +1,461 @@
+import threading, asyncio, time, random
+
+from multiprocessing import cpu_count
+from threading import Thread, Condition, Lock, Event
+from collections import deque
+from copy import deepcopy
+
+
+class ExitThread(BaseException):
+    """Raised on a worker thread when it notices that its pool has been cancelled."""
+    pass
+
+
+# Placeholder for a failed task in the results of an ordered pool
+NO_RESULT = object()
+
+
+class AdaptiveLimit:
+    """Limit on the number of tasks in flight that adapts to how well the server copes with the
+    load (AIMD): As long as tasks finish about as quickly as the fastest task seen so far, the
+    limit grows by one for every limit tasks. Congested tasks (timeouts, overload responses)
+    halve it, but only once per round trip, so that a burst of failures of tasks that were
+    started at the same time does not collapse it. A limit with minimum == maximum is fixed.
+
+    The limit does no locking of its own, the pools serialize all access to it."""
+
+    def __init__(self, initial, minimum=1, maximum=None, tolerance=1.5, backoff=0.5):
+        self.minimum = minimum
+        self.maximum = max(maximum or initial, initial)
+        self.limit = float(min(max(initial, minimum), self.maximum))
+        self.tolerance = tolerance
+        self.backoff = backoff
+
+        self.in_flight = 0
+        self.tasks_started = 0
+        self.decreased_at = 0
+        self.min_latency = None
+
+    def adaptive(self):
+        return self.minimum < self.maximum
+
+    def current(self):
+        return int(self.limit)
+
+    def available(self):
+        return self.in_flight < int(self.limit)
+
+    def task_started(self):
+        """Takes a slot and returns a ticket to be handed back to task_finished()."""
+        self.in_flight += 1
+        self.tasks_started += 1
+        return self.tasks_started, time.monotonic()
+
+    def task_finished(self, ticket, congested):
+        task_no, start_time = ticket
+        latency = time.monotonic() - start_time
+        self.in_flight -= 1
+
+        if congested:
+            # Tasks started before the last decrease saw the old limit, don't punish it twice
+            if task_no > self.decreased_at:
+                self.limit = max(self.minimum, self.limit * self.backoff)
+                self.decreased_at = self.tasks_started
+        else:
+            if self.min_latency is None or latency < self.min_latency:
+                self.min_latency = latency
+            if latency <= self.min_latency * self.tolerance:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+
+
+class RetryPolicy:
+    """How often and after how long transient failures are retried. The delay bound doubles with
+    every attempt and the actual delay is drawn at random below it, so that tasks which failed
+    together do not all retry at the same moment and overload the server again."""
+
+    def __init__(self, retries=0, delay=1.0, max_delay=30.0):
+        self.retries = retries
+        self.delay = delay
+        self.max_delay = max_delay
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.delay * 2 ** attempt))
+
+    def call(self, function, is_transient, cancelled=None):
+        """Calls function until it succeeds or the retries are used up. is_transient is given
+        the result and the exception of every attempt, one of them being None. If the event
+        cancelled is set while waiting for a retry, ExitThread is raised."""
+        attempt = 0
+        while True:
+            result, exception = None, None
+            try:
+                result = function()
+            except Exception as e:
+                exception = e
+
+            if attempt >= self.retries or not is_transient(result, exception):
+                if exception is not None:
+                    raise exception
+                return result
+
+            if cancelled is None:
+                time.sleep(self.backoff(attempt))
+            elif cancelled.wait(self.backoff(attempt)):
+                raise ExitThread()
+            attempt += 1
+
+
+class TokenBucket:
+    """Limits the rate of a resource shared by several threads, e.g. the bandwidth used by all
+    downloads together. The bucket fills up with rate tokens per second, up to a burst of
+    capacity tokens. Taking more tokens than available puts the bucket into debt, and the caller
+    has to wait until that is paid off."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.time = time.monotonic()
+        self.lock = Lock()
+
+    def reserve(self, amount):
+        """Takes amount tokens and returns the number of seconds to wait before using them."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.time) * self.rate)
+            self.time = now
+            self.tokens -= amount
+            return max(0, -self.tokens / self.rate)
+
+
+class TaskPool:
+    """Bookkeeping shared by ThreadPool and AsyncPool: Tasks are handed to defer(), done() marks
+    the end of a batch and iterating over the pool yields the results of the batch, re-raising
+    the first exception of a failed task. Results come in order of completion, or in the order
+    the tasks were deferred in if the pool is ordered. A pool can run any number of batches
+    one after another. The number of tasks executed at the same time is controlled by an
+    AdaptiveLimit, which backs off on congested tasks. Retryable tasks are retried according to
+    a RetryPolicy."""
+
+    def __init__(self, limit, retry, ordered=False):
+        self.limit = limit
+        self.retry = retry or RetryPolicy()
+        self.ordered = ordered
+        self.results = deque()
+        self.early_results = {}
+        self.next_result_no = 0
+        self.last_req_no = -1
+        self.last_finished_no = -1
+        self.done_at_no = -1
+        self.lock = Lock()
+        self.iter_cv = Condition(self.lock)
+        self.exception = None
+
+    def task_deferred(self):
+        """Returns the number of the new task. Must be called with self.lock held."""
+        self.done_at_no = -1
+        self.last_req_no += 1
+        return self.last_req_no
+
+    def add_result(self, task_no, result):
+        # Must be called with self.lock held
+        self.last_finished_no += 1
+        if not self.ordered:
+            if result is not NO_RESULT:
+                self.results.append(result)
+            return
+
+        # Hold back results until those of all earlier tasks are in
+        self.early_results[task_no] = result
+        while self.next_result_no in self.early_results:
+            result = self.early_results.pop(self.next_result_no)
+            if result is not NO_RESULT:
+                self.results.append(result)
+            self.next_result_no += 1
+
+    def task_finished(self, task_no, result):
+        with self.lock:
+            self.add_result(task_no, result)
+            self.iter_cv.notify()
+
+    def task_failed(self, task_no, exception):
+        with self.lock:
+            if task_no is not None:
+                self.add_result(task_no, NO_RESULT)
+            if self.exception is None:
+                self.exception = exception
+            self.iter_cv.notify()
+
+    def __iter__(self):
+        while True:
+            with self.lock:
+                self.iter_cv.wait_for(lambda: self.last_finished_no >= self.done_at_no
+                        or self.results or self.exception)
+                if self.exception:
+                    e = self.exception
+                    self.exception = None
+                    raise e
+                elif self.results:
+                    result = self.results.popleft()
+                else:
+                    return
+            # Do not hold the lock while the consumer processes the result, workers would
+            # otherwise be unable to pick up new tasks
+            yield result
+
+    def next_result(self):
+        """Waits for the next result without waiting for the batch to be done, so that results
+        can be consumed while more tasks are deferred. Must only be called while results are
+        still expected."""
+        with self.lock:
+            self.iter_cv.wait_for(lambda: self.results or self.exception)
+            self.raise_pending_exception()
+            return self.results.popleft()
+
+    def done(self):
+        with self.lock:
+            self.done_at_no = self.last_req_no
+
+    def is_congested(self, result, exception):
+        """Whether the outcome of a task indicates that the server is overloaded, which makes
+        an adaptive limit back off. Either result or exception is set."""
+        return False
+
+    def is_retryable(self, result, exception):
+        """Whether a task failed in a way that might not happen again, so that it is worth
+        retrying. By default, only congested tasks are retried."""
+        return self.is_congested(result, exception)
+
+    def raise_pending_exception(self):
+        if self.exception:
+            e = self.exception
+            self.exception = None
+            raise e
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.destroy()
+
+
+class ThreadPool(TaskPool):
+    """Executes tasks on n_threads worker threads. At most max_queued tasks wait for a worker,
+    defer() blocks while the queue is full, so that producers cannot get arbitrarily far ahead
+    of the workers.
+
+    Destroying the pool cancels it: Queued tasks are dropped and workers exit as soon as their
+    current task returns. Long-running tasks should check self.cancelled between steps and raise
+    ExitThread once it is set, so that they stop at a point where no file is left half-written.
+    A blocking network operation always runs to completion or to its timeout, though, so workers
+    still busy after join_timeout seconds are left behind. They are daemon threads and do not
+    keep the process from exiting."""
+
+    join_timeout = 5.0
+
+    def __init__(self, n_threads=cpu_count(), local_state={}, limit=None, retry=None,
+            max_queued=None, ordered=False):
+        # Without an adaptive limit, all threads work at the same time
+        super().__init__(limit or AdaptiveLimit(n_threads, n_threads, n_threads), retry, ordered)
+        self.threads = [ Thread(target=lambda i=i: self.thread_main(i, deepcopy(local_state)),
+                daemon=True) for i in range(n_threads) ]
+
+        self.queue = deque()
+        self.max_queued = max_queued or 4 * n_threads
+        self.thread_cv = Condition(self.lock)
+        self.queue_cv = Condition(self.lock)
+        self.cancelled = Event()
+
+        for thread in self.threads:
+            thread.start()
+
+    def init_thread(self, local_state):
+        pass
+
+    def cleanup_thread(self, local_state):
+        pass
+
+    def execute_task(self, local_state, task):
+        pass
+
+    def release_slot(self, ticket, congested):
+        with self.lock:
+            self.limit.task_finished(ticket, congested)
+            # The limit might have grown by more than one slot
+            self.thread_cv.notify_all()
+
+    def attempt_task(self, local_state, task):
+        """Executes a task once, waiting for a free slot of the limit first."""
+        with self.lock:
+            self.thread_cv.wait_for(lambda: self.limit.available() or self.cancelled.is_set())
+            if self.cancelled.is_set():
+                raise ExitThread()
+            ticket = self.limit.task_started()
+        try:
+            result = self.execute_task(local_state, task)
+        except Exception as e:
+            self.release_slot(ticket, self.is_congested(None, e))
+            raise
+        except BaseException:
+            self.release_slot(ticket, False)
+            raise
+        self.release_slot(ticket, self.is_congested(result, None))
+        return result
+
+    def thread_main(self, i, local_state):
+        local_state["thread_no"] = i
+        try:
+            self.init_thread(local_state)
+            try:
+                while True:
+                    with self.lock:
+                        self.thread_cv.wait_for(lambda: self.queue or self.cancelled.is_set())
+                        if self.cancelled.is_set():
+                            break
+                        task_no, task = self.queue.popleft()
+                        self.queue_cv.notify()
+                    try:
+                        result = self.retry.call(lambda: self.attempt_task(local_state, task),
+                                self.is_retryable, self.cancelled)
+                    except Exception as e:
+                        self.task_failed(task_no, e)
+                    else:
+                        self.task_finished(task_no, result)
+            finally:
+                self.cleanup_thread(local_state)
+        except ExitThread:
+            pass
+        except BaseException as e:
+            self.task_failed(None, e)
+
+    def defer(self, task):
+        with self.lock:
+            # A failed worker might never free up the queue, report its exception instead
+            self.queue_cv.wait_for(lambda: len(self.queue) < self.max_queued or self.exception)
+            if self.exception:
+                self.raise_pending_exception()
+            self.queue.append((self.task_deferred(), task))
+            self.thread_cv.notify()
+
+    def destroy(self):
+        self.cancelled.set()
+        with self.lock:
+            self.queue.clear()
+            # Wake up all waiting threads so that they see the pool is cancelled
+            self.thread_cv.notify_all()
+            self.queue_cv.notify_all()
+        deadline = time.monotonic() + self.join_timeout
+        for thread in self.threads:
+            thread.join(max(0, deadline - time.monotonic()))
+        self.raise_pending_exception()
+
+
+class AsyncPool(TaskPool):
+    """Counterpart to ThreadPool that runs tasks as coroutines on a single asyncio event loop.
+    The loop lives on a background thread, so the pool can be driven from synchronous code
+    exactly like a ThreadPool. At most max_tasks tasks are executed at the same time, or fewer if
+    an adaptive limit says so. Tasks still running when the pool is destroyed are cancelled."""
+
+    def __init__(self, max_tasks, limit=None, retry=None, ordered=False):
+        super().__init__(limit or AdaptiveLimit(max_tasks, max_tasks, max_tasks), retry,
+                ordered)
+        self.max_tasks = max_tasks
+        self.tasks = set()
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        try:
+            self.run_coroutine(self.start_loop())
+        except BaseException:
+            self.stop_thread()
+            raise
+
+    async def init_loop(self):
+        pass
+
+    async def cleanup_loop(self):
+        pass
+
+    async def execute_task(self, task):
+        pass
+
+    def run_coroutine(self, coroutine):
+        """Runs a coroutine on the pool's event loop and waits for its result."""
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def start_loop(self):
+        # Tasks waiting for a slot of the limit, as (task_no, task, attempt). All of this is
+        # only touched on the loop thread, so it does not need to take self.lock.
+        self.waiting = deque()
+        self.stopped = False
+        await self.init_loop()
+
+    async def stop_loop(self):
+        self.stopped = True
+        self.waiting.clear()
+        tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.cleanup_loop()
+
+    def start_waiting(self):
+        """Starts waiting tasks while the limit has free slots. A coroutine is only created
+        once a task gets a slot, so that finishing a task does not have to wake all others."""
+        while self.waiting and self.limit.available() and not self.stopped:
+            task_no, task, attempt = self.waiting.popleft()
+            future = self.loop.create_task(self.run_task(task_no, task, attempt,
+                    self.limit.task_started()))
+            self.tasks.add(future)
+            future.add_done_callback(self.tasks.discard)
+
+    async def run_task(self, task_no, task, attempt, ticket):
+        """Executes one attempt of a task in the slot given by ticket."""
+        result, exception = None, None
+        try:
+            result = await self.execute_task(task)
+        except asyncio.CancelledError:
+            # The pool is being destroyed, nobody waits for the slot anymore
+            self.limit.task_finished(ticket, False)
+            raise
+        except Exception as e:
+            exception = e
+        self.limit.task_finished(ticket, self.is_congested(result, exception))
+        self.start_waiting()
+
+        if attempt < self.retry.retries and self.is_retryable(result, exception):
+            # The slot is free for other tasks during the delay, the retry then goes first
+            self.loop.call_later(self.retry.backoff(attempt), self.retry_task, task_no, task,
+                    attempt + 1)
+        elif exception is None:
+            self.task_finished(task_no, result)
+        else:
+            self.task_failed(task_no, exception)
+
+    def retry_task(self, task_no, task, attempt):
+        if not self.stopped:
+            self.waiting.appendleft((task_no, task, attempt))
+            self.start_waiting()
+
+    def start_task(self, task_no, task):
+        # Called on the event loop thread
+        self.waiting.append((task_no, task, 0))
+        self.start_waiting()
+
+    def defer(self, task):
+        with self.lock:
+            task_no = self.task_deferred()
+        self.loop.call_soon_threadsafe(self.start_task, task_no, task)
+
+    def stop_thread(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def destroy(self):
+        try:
+            self.run_coroutine(self.stop_loop())
+        finally:
+            self.stop_thread()
+        self.raise_pending_exception()
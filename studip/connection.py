@@ -0,0 +1,240 @@
+import os, re, json, time, threading, requests
+
+from collections import deque
+from urllib.parse import parse_qsl, urlencode
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.cookies import RequestsCookieJar
+from requests.exceptions import ConnectionError, ReadTimeout, Timeout
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from urllib3.exceptions import ReadTimeoutError
+
+
+class SharedCookieJar(RequestsCookieJar):
+    """Cookie jar that can be used by sessions on several threads at once. CookieJar already
+    locks all modifications, this also protects iteration (e.g. when requests merges cookies
+    into a request) from concurrent changes."""
+
+    def __iter__(self):
+        with self._cookies_lock:
+            cookies = list(super().__iter__())
+        return iter(cookies)
+
+
+class TimeoutSession(requests.Session):
+    """Session whose requests give up after waiting timeout seconds for the server to connect
+    or to send more data, unless a request sets a timeout of its own. None waits forever, which
+    is the default of requests."""
+
+    def __init__(self, timeout=None):
+        super().__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return super().request(method, url, **kwargs)
+
+
+def create_session(pool_size, cookies=None, adapter=None, timeout=None):
+    """Creates a requests session whose keep-alive pool holds up to pool_size connections per
+    host. Sessions derived from it with share_session() use the same pool and timeout. A
+    different transport adapter, e.g. for recording or replaying requests, replaces the default
+    one if given."""
+    http = TimeoutSession(timeout)
+    http.cookies = SharedCookieJar()
+    if cookies is not None:
+        for cookie in cookies:
+            http.cookies.set_cookie(cookie)
+
+    if adapter is None:
+        adapter = HTTPAdapter(pool_maxsize=pool_size)
+    http.mount("https://", adapter)
+    http.mount("http://", adapter)
+    return http
+
+
+def release_response(r, drain_limit=64 * 1024):
+    """Releases a streamed response whose body has not been read completely. A remainder of up to
+    drain_limit bytes is read so that the connection can be kept alive, as opening a new one
+    costs more than that. Longer remainders are not received at all, the connection is closed."""
+    if r.raw is not None and not r.raw.closed:
+        try:
+            r.raw.read(drain_limit)
+        except Exception:
+            pass
+    r.close()
+
+
+def share_session(http, cookies=None):
+    """Creates a session for use on another thread which shares the connection pool of http.
+    Unless a separate cookie jar is given, cookies are shared as well. Sessions created this way
+    must not be closed, as that would close the shared pool."""
+    shared = TimeoutSession(http.timeout)
+    shared.cookies = http.cookies if cookies is None else cookies
+    for prefix, adapter in http.adapters.items():
+        shared.mount(prefix, adapter)
+    return shared
+
+
+# Request and response data that must not end up in a recording. The SAML response is signed
+# proof of a login and as good as a session cookie. Header names are compared in lower case.
+SCRUBBED_HEADERS = [ "authorization", "cookie", "set-cookie" ]
+SCRUBBED_FIELD = re.compile(r"user|pass|saml|relaystate", re.IGNORECASE)
+SCRUBBED_INPUT = re.compile(r"<input[^>]*name=\"(?:SAMLResponse|RelayState)\"[^>]*>",
+        re.IGNORECASE)
+SCRUBBED_VALUE = "scrubbed"
+
+# The stored bodies are already decoded, so these no longer describe them
+STALE_HEADERS = [ "content-encoding", "transfer-encoding", "content-length" ]
+
+
+def scrub_headers(headers):
+    return dict((k, v) for k, v in headers.items() if k.lower() not in SCRUBBED_HEADERS)
+
+
+def scrub_form(body):
+    if body is None:
+        return None
+    if isinstance(body, bytes):
+        body = body.decode("utf-8", "replace")
+    if not isinstance(body, str):
+        return "<stream>"
+    fields = parse_qsl(body, keep_blank_values=True)
+    return urlencode([ (k, SCRUBBED_VALUE if SCRUBBED_FIELD.search(k) else v)
+            for k, v in fields ])
+
+
+def scrub_page(content):
+    def scrub_input(match):
+        return re.sub(r"value=\"[^\"]*\"", "value=\"{}\"".format(SCRUBBED_VALUE),
+                match.group(0))
+
+    try:
+        text = content.decode("utf-8")
+    except UnicodeDecodeError:
+        return content
+    return SCRUBBED_INPUT.sub(scrub_input, text).encode("utf-8")
+
+
+class RecordingAdapter(HTTPAdapter):
+    """Transport adapter that saves every exchange to a directory while passing it on to the
+    server. Each exchange is a line in exchanges.jsonl, its response body is stored separately
+    in bodies/. Cookies, credentials and SAML assertions are scrubbed, personal data on the pages
+    themselves is not. Responses are read completely before they are returned, so streamed
+    downloads are buffered in memory."""
+
+    def __init__(self, directory, **kwargs):
+        super().__init__(**kwargs)
+        self.directory = directory
+        os.makedirs(os.path.join(directory, "bodies"), exist_ok=True)
+        self.index = open(os.path.join(directory, "exchanges.jsonl"), "w")
+        self.lock = threading.Lock()
+        self.n_exchanges = 0
+
+    def record(self, request, latency, response=None, error=None):
+        exchange = {
+            "method": request.method,
+            "url": request.url,
+            "request_headers": scrub_headers(request.headers),
+            "request_body": scrub_form(request.body),
+            "latency": latency,
+        }
+        if response is not None:
+            exchange.update({
+                "status": response.status_code,
+                "reason": response.reason,
+                "headers": scrub_headers(response.headers),
+            })
+        else:
+            exchange["error"] = error
+
+        with self.lock:
+            self.n_exchanges += 1
+            if response is not None:
+                exchange["body"] = "{:06d}".format(self.n_exchanges)
+                with open(os.path.join(self.directory, "bodies", exchange["body"]), "wb") as file:
+                    file.write(scrub_page(response.content))
+            self.index.write(json.dumps(exchange) + "\n")
+            self.index.flush()
+
+    def send(self, request, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = super().send(request, **kwargs)
+            response.content
+        except (Timeout, ConnectionError) as e:
+            # Newer versions of requests report read timeouts as a ConnectionError
+            timeout = isinstance(e, Timeout) or (e.args and isinstance(e.args[0],
+                    ReadTimeoutError))
+            self.record(request, time.perf_counter() - start,
+                    error="timeout" if timeout else "connection")
+            raise
+        self.record(request, time.perf_counter() - start, response)
+        return response
+
+    def close(self):
+        super().close()
+        with self.lock:
+            self.index.close()
+
+
+class ReplayAdapter(BaseAdapter):
+    """Transport adapter that answers requests from a directory written by RecordingAdapter,
+    without network access. Exchanges are matched by method and URL; repeated requests get the
+    recorded responses in order, and the last one again once those run out. Each response is
+    delayed by its recorded latency times latency_scale. Requests that were never recorded are
+    answered with 404."""
+
+    def __init__(self, directory, latency_scale=1.0):
+        super().__init__()
+        self.directory = directory
+        self.latency_scale = latency_scale
+        self.lock = threading.Lock()
+        self.exchanges = {}
+        with open(os.path.join(directory, "exchanges.jsonl"), "r") as file:
+            for line in file:
+                exchange = json.loads(line)
+                key = (exchange["method"], exchange["url"])
+                self.exchanges.setdefault(key, deque()).append(exchange)
+
+    def next_exchange(self, request):
+        with self.lock:
+            queue = self.exchanges.get((request.method, request.url))
+            if not queue:
+                return None
+            return queue.popleft() if len(queue) > 1 else queue[0]
+
+    def build_response(self, request, status, reason, headers, content):
+        response = Response()
+        response.status_code = status
+        response.reason = reason
+        response.headers = CaseInsensitiveDict(headers)
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        response._content = content
+        response._content_consumed = True
+        return response
+
+    def send(self, request, **kwargs):
+        exchange = self.next_exchange(request)
+        if exchange is None:
+            return self.build_response(request, 404, "Not Recorded", {}, b"")
+
+        time.sleep(exchange["latency"] * self.latency_scale)
+        if "error" in exchange:
+            error_class = ReadTimeout if exchange["error"] == "timeout" else ConnectionError
+            raise error_class("Recorded {} error".format(exchange["error"]), request=request)
+
+        with open(os.path.join(self.directory, "bodies", exchange["body"]), "rb") as file:
+            content = file.read()
+        headers = dict((k, v) for k, v in exchange["headers"].items()
+                if k.lower() not in STALE_HEADERS)
+        headers["Content-Length"] = str(len(content))
+        return self.build_response(request, exchange["status"], exchange["reason"], headers,
+                content)
+
+    def close(self):
+        pass
@@ -1,5 +1,6 @@
-import sqlite3, os, ast, shutil, re
+import sqlite3, os, shutil, re, time
 from enum import IntEnum
+from urllib.request import pathname2url
 
 from .util import EscapeMode, Charset, abbreviate_course_name, abbreviate_course_type
 
@@ -123,19 +124,46 @@ class QueryError(Exception):
     pass
 
 
+# Separates the folder names in the materialized path of a folder
+FOLDER_PATH_SEPARATOR = "\x1f"
+
+def split_folder_path(path):
+    return path.split(FOLDER_PATH_SEPARATOR) if path else []
+
+
+JOURNAL_MODES = [ "delete", "truncate", "persist", "memory", "wal", "off" ]
+SYNCHRONOUS_MODES = [ "off", "normal", "full", "extra" ]
+
+
 class Database:
-    schema_version = 12
+    schema_version = 17
+
+    def __init__(self, file_name, profile={}, read_only=False):
+        """Opens the database in file_name, creating or migrating it if necessary. profile may
+        set journal_mode, synchronous, cache_size (in KiB) and mmap_size (in bytes) for the
+        connection. A read-only connection fails with DatabaseVersionError instead of creating
+        or migrating the database."""
+        # Folder ids by (parent, name) and root folders by course, see create_parent_for_file
+        self.folder_tree = {}
+        self.course_roots = {}
 
-    def __init__(self, file_name):
         def connect(self):
-            self.conn = sqlite3.connect(file_name, detect_types=sqlite3.PARSE_DECLTYPES)
+            if read_only:
+                self.conn = sqlite3.connect("file:{}?mode=ro".format(pathname2url(file_name)),
+                        uri=True, detect_types=sqlite3.PARSE_DECLTYPES)
+            else:
+                self.conn = sqlite3.connect(file_name, detect_types=sqlite3.PARSE_DECLTYPES)
+            self.apply_profile(profile, read_only)
 
         # Try using the existing db, if the version differs from the internal schema version,
         # delete the database and start over
         connect(self)
         db_version, = self.query("PRAGMA user_version", expected_rows=1)[0]
+        if read_only and db_version != self.schema_version:
+            self.conn.close()
+            raise DatabaseVersionError()
         if db_version < self.schema_version:
-            if db_version in [ 9, 11 ]:
+            if db_version in [ 9, 11, 12, 13, 14, 15, 16 ]:
                 # Disconnect and reconnect to create a backup
                 self.conn.close()
                 base_name, ext = os.path.splitext(file_name)
@@ -147,6 +175,16 @@ class Database:
                     self.query_script_file("migrate-9-11.sql")
                 if db_version < 12:
                     self.query_script_file("migrate-11-12.sql")
+                if db_version < 13:
+                    self.query_script_file("migrate-12-13.sql")
+                if db_version < 14:
+                    self.query_script_file("migrate-13-14.sql")
+                if db_version < 15:
+                    self.query_script_file("migrate-14-15.sql")
+                if db_version < 16:
+                    self.query_script_file("migrate-15-16.sql")
+                if db_version < 17:
+                    self.query_script_file("migrate-16-17.sql")
 
                 print("Migrated database from version {} to {}, backup saved to {}".format(
                         db_version, self.schema_version, backup_file))
@@ -168,6 +206,26 @@ class Database:
             self.conn.close()
             raise DatabaseVersionError()
 
+    def apply_profile(self, profile, read_only):
+        # The journal mode is stored in the database file and can only be changed by a writer
+        if "journal_mode" in profile and not read_only:
+            mode = str(profile["journal_mode"]).lower()
+            if mode not in JOURNAL_MODES:
+                raise ValueError("Unknown journal mode \"{}\"".format(mode))
+            self.query("PRAGMA journal_mode = " + mode, expected_rows=0)
+        if "synchronous" in profile:
+            mode = str(profile["synchronous"]).lower()
+            if mode not in SYNCHRONOUS_MODES:
+                raise ValueError("Unknown synchronous mode \"{}\"".format(mode))
+            self.query("PRAGMA synchronous = " + mode, expected_rows=0)
+        if "cache_size" in profile:
+            # Negative sizes are in KiB instead of pages
+            self.query("PRAGMA cache_size = " + str(-int(profile["cache_size"])),
+                    expected_rows=0)
+        if "mmap_size" in profile:
+            self.query("PRAGMA mmap_size = " + str(int(profile["mmap_size"])), expected_rows=0)
+
+
     def query(self, sql, expected_rows=-1, *args, **kwargs):
         cursor = self.conn.cursor()
         if args:
@@ -209,6 +267,14 @@ class Database:
             """, (s.__dict__ for s in semesters))
 
 
+    def list_semesters(self):
+        rows = self.query("""
+                SELECT id, name, ord FROM semesters
+                ORDER BY ord DESC;
+            """)
+        return [ Semester(i, n, o) for i, n, o in rows ]
+
+
     def list_courses(self, full=False, select_sync_yes=True, select_sync_metadata_only=True,
             select_sync_no=True):
         sync_modes = [ str(int(enum)) for enable, enum in [ (select_sync_yes, SyncMode.Full),
@@ -289,8 +355,7 @@ class Database:
                     FROM file_details
                     WHERE sync IN ({});
                 """.format(", ".join(sync_modes)))
-            # Path is encoded as the string representation of a python list
-            return [ File(i, j, s, c, b, o, u, ast.literal_eval(path), n, e, a, d, t, y, l, v)
+            return [ File(i, j, s, c, b, o, u, split_folder_path(path), n, e, a, d, t, y, l, v)
                     for i, j, s, c, b, o, u, path, n, e, a, d, t, y, l, v in rows ]
 
         else:
@@ -302,58 +367,76 @@ class Database:
             return [id for (id,) in rows]
 
 
-    def create_parent_for_file(self, file):
+    def load_folder_tree(self, course_id):
         rows = self.query("""
-                SELECT root FROM courses
-                WHERE id = :course
-            """, course=file.course)
-        parent, = rows[0]
+                SELECT courses.root, folders.id, folders.parent, folders.name
+                FROM courses
+                LEFT OUTER JOIN folders ON folders.course = courses.id
+                    AND folders.parent IS NOT NULL
+                WHERE courses.id = :course
+            """, course=course_id)
+        for root, id, parent, name in rows:
+            self.course_roots[course_id] = root
+            if id is not None:
+                self.folder_tree[parent, name] = id
+
+
+    def create_parent_for_file(self, file):
+        # The folders of a course are looked up in a single query on first use, and afterwards
+        # only new folders touch the database
+        if file.course not in self.course_roots:
+            self.load_folder_tree(file.course)
+        parent = self.course_roots[file.course]
 
         for folder in file.path:
-            def query_subdirectory():
-                return self.query("""
-                        SELECT id FROM folders
-                        WHERE parent = :par AND name = :name
-                    """, par=parent, name=folder)
-
-            rows = query_subdirectory()
-            if not rows:
-                self.query("""
+            id = self.folder_tree.get((parent, folder))
+            if id is None:
+                id = self.conn.execute("""
                         INSERT INTO folders (name, parent)
                         VALUES(:name, :par)
-                    """, name=folder, par=parent, expected_rows=0)
-                rows = query_subdirectory()
-            parent, = rows[0]
+                    """, dict(name=folder, par=parent)).lastrowid
+                self.folder_tree[parent, folder] = id
+            parent = id
 
         return parent
 
 
-    def add_file(self, file):
-        parent = self.create_parent_for_file(file)
-        self.query("""
+    def file_row(self, file):
+        return dict(id=file.id, par=self.create_parent_for_file(file), name=file.name,
+                ext=file.extension, auth=file.author, descr=file.description,
+                creat=file.remote_date, copy=file.copyrighted, local=file.local_date)
+
+
+    def store_files(self, new_files, updated_files):
+        """Adds new_files and updates updated_files, removing the checkouts of the latter, with
+        one executemany() per kind of statement. Nothing is committed, so that a course can be
+        stored in a single transaction. Returns the time taken in seconds."""
+        start = time.perf_counter()
+        self.query_multiple("""
                 INSERT INTO files (id, folder, name, extension, author, description, remote_date,
                     copyrighted, local_date, version)
                 VALUES (:id, :par, :name, :ext, :auth, :descr, :creat, :copy, :local, 0);
-            """, id=file.id, par=parent, name=file.name, ext=file.extension, auth=file.author,
-                descr=file.description, creat=file.remote_date, copy=file.copyrighted,
-                local=file.local_date, expected_rows=0)
-
-
-    def update_file(self, file):
-        parent = self.create_parent_for_file(file)
-        self.query("""
+            """, [ self.file_row(file) for file in new_files ])
+        self.query_multiple("""
                 UPDATE files
                 SET folder = :par, name = :name, extension = :ext, author = :auth,
                     description = :descr, remote_date = :creat, copyrighted = :copy,
                     local_date = :local, version = version + 1
                 WHERE id = :id;
-            """, id=file.id, par=parent, name=file.name, ext=file.extension, auth=file.author,
-                descr=file.description, creat=file.remote_date, copy=file.copyrighted,
-                local=file.local_date, expected_rows=0)
-        self.query("""
+            """, [ self.file_row(file) for file in updated_files ])
+        self.query_multiple("""
                 DELETE FROM checkouts
                 WHERE file=:id
-            """, id=file.id, expected_rows=0)
+            """, [ dict(id=file.id) for file in updated_files ])
+        return time.perf_counter() - start
+
+
+    def add_file(self, file):
+        self.store_files([ file ], [])
+
+
+    def update_file(self, file):
+        self.store_files([], [ file ])
 
 
     def update_file_local_date(self, file):
@@ -364,6 +447,59 @@ class Database:
             """, id=file.id, local=file.local_date, expected_rows=0)
 
 
+    def list_partial_fetches(self):
+        rows = self.query("""
+                SELECT file, version, remote_date, bytes
+                FROM fetch_journal
+            """)
+        return dict((id, (version, date, bytes)) for id, version, date, bytes in rows)
+
+
+    def add_partial_fetch(self, file, bytes=0):
+        self.query("""
+                INSERT OR REPLACE INTO fetch_journal (file, version, remote_date, bytes)
+                VALUES (:id, :version, :date, :bytes)
+            """, id=file.id, version=file.version, date=file.remote_date, bytes=bytes,
+                expected_rows=0)
+
+
+    def update_partial_fetch(self, file_id, bytes):
+        self.query("""
+                UPDATE fetch_journal
+                SET bytes = :bytes
+                WHERE file = :id
+            """, id=file_id, bytes=bytes, expected_rows=0)
+
+
+    def remove_partial_fetch(self, file_id):
+        self.query("""
+                DELETE FROM fetch_journal
+                WHERE file = :id
+            """, id=file_id, expected_rows=0)
+
+
+    def list_update_checkpoints(self, since):
+        rows = self.query("""
+                SELECT course
+                FROM update_checkpoints
+                WHERE time >= :since
+            """, since=since)
+        return [ course for (course,) in rows ]
+
+
+    def add_update_checkpoint(self, course, time):
+        self.query("""
+                INSERT OR REPLACE INTO update_checkpoints (course, time)
+                VALUES (:course, :time)
+            """, course=course.id, time=time, expected_rows=0)
+
+
+    def clear_update_checkpoints(self):
+        self.query("""
+                DELETE FROM update_checkpoints
+            """, expected_rows=0)
+
+
     def list_views(self, full=False):
         if full:
             rows = self.query("""
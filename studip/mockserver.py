@@ -0,0 +1,621 @@
+"""Local stand-in for the Stud.IP and Shibboleth web interfaces.
+
+The server generates a synthetic account and serves just enough of the web interface for the
+unmodified client to log in, list courses and folders and download files. It is meant for
+offline regression tests and benchmarks:
+
+    $ python3 -m studip.mockserver --port 8123 --courses 10 --files 20
+
+and then point the [server] section of a sync directory's studip.conf to it:
+
+    studip_base = 'http://127.0.0.1:8123'
+    sso_base = 'http://127.0.0.1:8123'
+"""
+
+import sys, os, time, hashlib, zipfile, io, threading, argparse, random
+
+from datetime import datetime, timedelta
+from html import escape
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.cookies import SimpleCookie
+from socketserver import ThreadingMixIn
+from urllib.parse import urlsplit, parse_qs, urlencode, quote
+
+
+def make_id(*parts):
+    return hashlib.md5("/".join(str(p) for p in parts).encode("utf-8")).hexdigest()
+
+
+class MockFile:
+    def __init__(self, id, folder, name, extension, description, author, date, size,
+            copyrighted=False, collapsed=False):
+        self.id = id
+        self.folder = folder
+        self.name = name
+        self.extension = extension
+        self.description = description
+        self.author = author
+        self.date = date
+        self.size = size
+        self.copyrighted = copyrighted
+        # Collapsed files are listed without their details, as Stud.IP does for some entries
+        self.collapsed = collapsed
+
+    @property
+    def file_name(self):
+        return self.name + ("." + self.extension if self.extension else "")
+
+    def content(self, start=0, end=None):
+        """Deterministic pseudo-random file content, generated in blocks of 4 KiB."""
+        end = self.size if end is None else min(end, self.size)
+        block_size = 4096
+        block = start // block_size
+        offset = start - block * block_size
+        while start < end:
+            data = hashlib.sha512("{}:{}".format(self.id, block).encode("ascii")).digest() * 64
+            data = data[offset : offset + end - start]
+            yield data
+            start += len(data)
+            block += 1
+            offset = 0
+
+
+class MockFolder:
+    def __init__(self, id, name, path):
+        self.id = id
+        self.name = name
+        self.path = path
+
+
+class MockCourse:
+    def __init__(self, id, number, name, type):
+        self.id = id
+        self.number = number
+        self.name = name
+        self.type = type
+        self.folders = []
+        self.files = []
+
+
+class MockAccount:
+    """A synthetic Stud.IP account with deterministically generated courses and files."""
+
+    course_types = [ "Vorlesung", "Übung", "Seminar", "Tutorium", "Praktikum" ]
+
+    def __init__(self, user_name="student", password="secret", courses=5, folders=2,
+            depth=1, files=5, file_size=16 * 1024, size_spread=0.5, copyrighted=0.1,
+            collapsed=0.1, semester="WS 16/17", seed=0):
+        self.user_name = user_name
+        self.password = password
+        self.semester_name = semester
+        self.semester_id = make_id("semester", semester)
+        self.courses = []
+        self.files = {}
+
+        rng = random.Random(seed)
+        # Drawn separately so that the other properties do not depend on the share of collapsed
+        # files
+        collapse_rng = random.Random("collapsed {}".format(seed))
+        base_date = datetime(2016, 10, 1, 8, 0)
+        for c in range(courses):
+            course = MockCourse(make_id("course", seed, c), "{:04}".format(c + 1),
+                    "Synthetic Course {}".format(c + 1),
+                    self.course_types[c % len(self.course_types)])
+
+            course_folders = [ MockFolder(make_id("folder", course.id, 0),
+                    "Allgemeiner Dateiordner", [ "Allgemeiner Dateiordner" ]) ]
+            parents = course_folders[:]
+            for level in range(depth):
+                children = []
+                for parent in parents:
+                    for f in range(folders):
+                        name = "Folder {}.{}".format(level + 1, f + 1)
+                        children.append(MockFolder(make_id("folder", parent.id, f), name,
+                                parent.path + [ name ]))
+                course_folders += children
+                parents = children
+            course.folders = course_folders
+
+            for i in range(files):
+                folder = course_folders[i % len(course_folders)]
+                id = make_id("file", course.id, i)
+                size = max(1, int(file_size * (1 + size_spread * (2 * rng.random() - 1))))
+                date = base_date + timedelta(days=c, minutes=17 * i)
+                file = MockFile(id, folder, "document_{}_{}".format(c + 1, i + 1), "pdf",
+                        "Document {} of course {}.pdf".format(i + 1, c + 1),
+                        "Lecturer {}".format(c % 7 + 1), date, size,
+                        rng.random() < copyrighted, collapse_rng.random() < collapsed)
+                course.files.append(file)
+                self.files[id] = file
+
+            self.courses.append(course)
+
+        self.course_dict = dict((c.id, c) for c in self.courses)
+
+    def touch(self, fraction=0.1, seed=1):
+        """Move the modification date of a fraction of all files forward, as if a new
+        version had been uploaded."""
+        rng = random.Random(seed)
+        touched = 0
+        for file in self.files.values():
+            if rng.random() < fraction:
+                file.date += timedelta(days=1)
+                touched += 1
+        return touched
+
+
+class MockState:
+    def __init__(self, account, latency=0, ranges=True, zip_downloads=True, bandwidth=0,
+            capacity=0, failure_rate=0):
+        self.account = account
+        self.latency = latency
+        # Above capacity concurrent requests, requests slow down, above twice as many they are
+        # rejected with 503. failure_rate is the probability of a spurious 503.
+        self.capacity = capacity
+        self.failure_rate = failure_rate
+        self.in_flight = 0
+        self.random = random.Random(0)
+        self.bandwidth = bandwidth
+        self.ranges = ranges
+        self.zip_downloads = zip_downloads
+        self.lock = threading.Lock()
+        self.idp_sessions = set()
+        self.saml_tokens = set()
+        self.sessions = {}
+        self.requests = {}
+        self.bytes_sent = 0
+
+    def count(self, name, bytes=0):
+        with self.lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+            self.bytes_sent += bytes
+
+    def reset_stats(self):
+        with self.lock:
+            self.requests = {}
+            self.bytes_sent = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                "requests": dict(self.requests),
+                "total_requests": sum(self.requests.values()),
+                "bytes_sent": self.bytes_sent
+            }
+
+    def enter_request(self):
+        """Registers a request being handled. Returns its delay, or None if it is rejected."""
+        with self.lock:
+            self.in_flight += 1
+            if self.failure_rate and self.random.random() < self.failure_rate:
+                return None
+            if not self.capacity:
+                return self.latency
+            if self.in_flight > 2 * self.capacity:
+                return None
+            return self.latency * max(1, self.in_flight / self.capacity)
+
+    def leave_request(self):
+        with self.lock:
+            self.in_flight -= 1
+
+    def expire_sessions(self):
+        """Invalidate all Stud.IP sessions, forcing clients to go through SSO again."""
+        with self.lock:
+            self.sessions.clear()
+
+
+DATE_FORMAT = "%d.%m.%Y - %H:%M"
+
+PAGE_HEAD = ('<!DOCTYPE html>\n<html><head><meta charset="utf-8"><title>{}</title></head>'
+        '<body>\n')
+PAGE_TAIL = '</body></html>\n'
+
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "StudIPMock/1.0"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    @property
+    def state(self):
+        return self.server.state
+
+    # Request plumbing
+
+    def parse_request_data(self):
+        url = urlsplit(self.path)
+        self.url_path = url.path
+        self.query = parse_qs(url.query, keep_blank_values=True)
+        self.form = {}
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            body = self.rfile.read(length).decode("utf-8", "replace")
+            self.form = parse_qs(body, keep_blank_values=True)
+        self.cookies = SimpleCookie()
+        if "Cookie" in self.headers:
+            try:
+                self.cookies.load(self.headers["Cookie"])
+            except Exception:
+                pass
+
+    def param(self, name, default=None):
+        if name in self.form:
+            return self.form[name][0]
+        if name in self.query:
+            return self.query[name][0]
+        return default
+
+    def cookie(self, name):
+        return self.cookies[name].value if name in self.cookies else None
+
+    def send_body(self, status, body, content_type="text/html; charset=utf-8", headers={}):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+        self.state.count(self.url_path, len(body))
+
+    def redirect(self, location, headers={}):
+        headers = dict(headers, Location=location)
+        self.send_body(302, "", headers=headers)
+
+    def page(self, title, content, headers={}):
+        self.send_body(200, PAGE_HEAD.format(escape(title)) + content + PAGE_TAIL,
+                headers=headers)
+
+    def base_url(self):
+        return "http://{}:{}".format(*self.server.server_address[:2])
+
+    def studip_session(self):
+        id = self.cookie("Seminar_Session")
+        with self.state.lock:
+            return self.state.sessions.get(id) if id else None
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        self.dispatch()
+
+    def do_POST(self):
+        self.dispatch()
+
+    def dispatch(self):
+        self.parse_request_data()
+        delay = self.state.enter_request()
+        try:
+            if delay is None:
+                self.state.count("rejected")
+                self.send_response(503)
+                self.send_header("Retry-After", "1")
+                self.send_header("Content-Type", "text/plain")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            if delay:
+                time.sleep(delay)
+            self.route()
+        finally:
+            self.state.leave_request()
+
+    def route(self):
+        routes = {
+            "/studip/index.php": self.handle_index,
+            "/idp/profile/SAML2/Redirect/SSO": self.handle_idp,
+            "/Shibboleth.sso/SAML2/POST": self.handle_saml_post,
+            "/studip/dispatch.php/my_courses": self.handle_my_courses,
+            "/studip/dispatch.php/my_courses/set_semester": self.handle_my_courses,
+            "/studip/seminar_main.php": self.handle_seminar_main,
+            "/studip/folder.php": self.handle_folder,
+            "/studip/sendfile.php": self.handle_sendfile,
+        }
+        handler = routes.get(self.url_path)
+        if handler is None:
+            self.send_body(404, "Not found", "text/plain")
+            return
+        if self.url_path.startswith("/studip/") and self.url_path != "/studip/index.php" \
+                and self.studip_session() is None:
+            self.redirect(self.base_url() + "/studip/index.php?cancel_login=1")
+            return
+        handler()
+
+    # Login flow
+
+    def handle_index(self):
+        if self.param("sso") == "shib":
+            self.redirect(self.base_url() + "/idp/profile/SAML2/Redirect/SSO?execution=e1s1")
+        else:
+            self.page("Stud.IP", '<div id="index"><a href="/studip/index.php?again=yes&amp;'
+                    'sso=shib">Login</a></div>\n')
+
+    def saml_form(self):
+        token = os.urandom(16).hex()
+        with self.state.lock:
+            self.state.saml_tokens.add(token)
+        return ('<form action="{}/Shibboleth.sso/SAML2/POST" method="post">\n'
+                '<input type="hidden" name="RelayState" value="ss:mem:{}"/>\n'
+                '<input type="hidden" name="SAMLResponse" value="{}"/>\n'
+                '<input type="submit" value="Continue"/>\n</form>\n').format(
+                self.base_url(), make_id("relay", token), token)
+
+    def login_form(self, error=None):
+        content = ""
+        if error:
+            content += '<p class="form-element form-error">{}</p>\n'.format(escape(error))
+        content += ('<form action="/idp/profile/SAML2/Redirect/SSO?execution=e1s1" '
+                'method="post">\n<input name="j_username"/>\n'
+                '<input name="j_password" type="password"/>\n</form>\n')
+        return content
+
+    def handle_idp(self):
+        with self.state.lock:
+            idp_session = self.cookie("shib_idp_session") in self.state.idp_sessions
+        if self.command == "POST":
+            account = self.state.account
+            if self.param("j_username") == account.user_name \
+                    and self.param("j_password") == account.password:
+                session = os.urandom(16).hex()
+                with self.state.lock:
+                    self.state.idp_sessions.add(session)
+                self.page("SAML", self.saml_form(), headers={
+                        "Set-Cookie": "shib_idp_session={}; Path=/; HttpOnly".format(session) })
+            else:
+                self.page("Login", self.login_form("The password you entered was incorrect."))
+        elif idp_session:
+            # Single sign-on: an active IdP session skips the credentials form
+            self.page("SAML", self.saml_form())
+        else:
+            self.page("Login", self.login_form())
+
+    def handle_saml_post(self):
+        token = self.param("SAMLResponse")
+        with self.state.lock:
+            valid = token in self.state.saml_tokens
+            self.state.saml_tokens.discard(token)
+            if valid:
+                session = os.urandom(16).hex()
+                self.state.sessions[session] = { "course": None }
+        if not valid:
+            self.send_body(403, "Invalid SAML response", "text/plain")
+            return
+        self.redirect(self.base_url() + "/studip/index.php", headers={
+                "Set-Cookie": "Seminar_Session={}; Path=/; HttpOnly".format(session) })
+
+    # Stud.IP pages
+
+    def handle_my_courses(self):
+        account = self.state.account
+        content = ('<form><select name="sem_select">\n'
+                '<option selected value="current">Aktuelles Semester</option>\n'
+                '<optgroup label="Semester">\n<option value="{}">{}</option>\n</optgroup>\n'
+                '</select></form>\n').format(account.semester_id, escape(account.semester_name))
+        content += ('<div id="my_seminars"><table>\n<caption>{}</caption>\n'
+                '<thead><tr><th></th><th></th><th>Nr.</th><th>Name</th><th></th></tr></thead>\n'
+                '<tbody>\n').format(escape(account.semester_name))
+        for course in account.courses:
+            content += ('<tr><td></td><td><img src="icon.png"/></td><td>{}</td>'
+                    '<td><a href="/studip/seminar_main.php?auswahl={}">{} ({})</a></td>'
+                    '<td></td></tr>\n').format(course.number, course.id, escape(course.name),
+                    escape(course.type))
+        content += '</tbody>\n</table></div>\n'
+        self.page("Meine Veranstaltungen", content)
+
+    def handle_seminar_main(self):
+        course = self.state.account.course_dict.get(self.param("auswahl"))
+        if course is None:
+            self.send_body(404, "No such course", "text/plain")
+            return
+        session = self.studip_session()
+        with self.state.lock:
+            session["course"] = course.id
+        self.page(course.name, '<div id="course">{}</div>\n'.format(escape(course.name)))
+
+    def file_div(self, course, file, expanded):
+        # Only expanded files have a bold header and the body with their folder, collapsed ones
+        # just a download link
+        if expanded:
+            header = '<span id="file_{}_header" style="font-weight: bold">{}</span>'.format(
+                    file.id, escape(file.description))
+        else:
+            header = ('<span id="file_{}_header">{}</span>\n<a href="/studip/sendfile.php?'
+                    'type=0&amp;{}">download</a>').format(file.id, escape(file.description),
+                    escape(urlencode({ "file_id": file.id, "file_name": file.file_name })))
+        content = ('<div id="file_{0}_0">\n<table><tr><td>{1}</td>\n<td><a href="/studip/'
+                'dispatch.php/profile?username=u{2}">{3}</a> {4}</td></tr></table>\n').format(
+                file.id, header, make_id(file.author)[:8], escape(file.author),
+                file.date.strftime(DATE_FORMAT))
+        if expanded:
+            content += ('<div id="file_{0}_body">\n<a href="/studip/folder.php?cid={1}&amp;'
+                    'open={2}#anker">{3}</a>\n<a href="/studip/sendfile.php?type=0&amp;{4}">'
+                    '{5}</a>\n').format(file.id, course.id, file.folder.id,
+                    escape(" / ".join(file.folder.path)),
+                    escape(urlencode({ "file_id": file.id, "file_name": file.file_name })),
+                    escape(file.file_name))
+            if file.copyrighted:
+                content += ('<div class="messagebox messagebox_info">Diese Datei ist '
+                        'urheberrechtlich geschützt.</div>\n')
+            content += '</div>\n'
+        content += '</div>\n'
+        return content
+
+    def handle_folder(self):
+        course = self.state.account.course_dict.get(self.param("cid"))
+        session = self.studip_session()
+        with self.state.lock:
+            selected = session["course"]
+        if course is None or course.id != selected:
+            self.page("Dateiordner", '<div class="messagebox messagebox_error">Keine '
+                    'Veranstaltung ausgewählt.</div>\n')
+            return
+
+        if self.command == "POST" and self.param("download_selected"):
+            self.send_zip(course, self.form.get("download_ids[]", []))
+            return
+
+        open_id = self.param("open")
+        if open_id:
+            files = [ f for f in course.files if f.id == open_id ]
+        else:
+            files = course.files
+        content = '<div id="folders">\n'
+        content += ''.join(self.file_div(course, f, bool(open_id) or not f.collapsed)
+                for f in files)
+        content += '</div>\n'
+        self.page("Dateiordner", content)
+
+    def send_zip(self, course, file_ids):
+        if not self.state.zip_downloads:
+            self.send_body(404, "Not found", "text/plain")
+            return
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as archive:
+            for file in course.files:
+                if file.id in file_ids:
+                    info = zipfile.ZipInfo("/".join(file.folder.path + [ file.file_name ]),
+                            file.date.timetuple()[:6])
+                    archive.writestr(info, b"".join(file.content()))
+        self.send_body(200, buffer.getvalue(), "application/zip", headers={
+                "Content-Disposition": 'attachment; filename="{}.zip"'.format(course.number) })
+
+    def handle_sendfile(self):
+        file = self.state.account.files.get(self.param("file_id"))
+        if file is None:
+            self.send_body(404, "No such file", "text/plain")
+            return
+
+        start, end = 0, file.size
+        status = 200
+        range_header = self.headers.get("Range")
+        if self.state.ranges and range_header and range_header.startswith("bytes="):
+            try:
+                first, last = range_header[6:].split("-", 1)
+                start = int(first)
+                end = int(last) + 1 if last else file.size
+            except ValueError:
+                start, end = 0, file.size
+            else:
+                if start >= file.size:
+                    self.send_body(416, "", "text/plain", headers={
+                            "Content-Range": "bytes */{}".format(file.size) })
+                    return
+                end = min(end, file.size)
+                status = 206
+
+        self.send_response(status)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start))
+        self.send_header("Content-Disposition", "attachment; filename=\"{}\"".format(
+                quote(file.file_name)))
+        if self.state.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end - 1, file.size))
+        self.end_headers()
+        if self.command != "HEAD":
+            try:
+                for chunk in file.content(start, end):
+                    self.wfile.write(chunk)
+                    if self.state.bandwidth:
+                        time.sleep(len(chunk) / self.state.bandwidth)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+        self.state.count(self.url_path, end - start if self.command != "HEAD" else 0)
+
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        # The client drops the connection on purpose when selecting a course
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class MockServer:
+    """Runs the stand-in server on a background thread:
+
+        with MockServer(MockAccount(courses=10)) as server:
+            print(server.url)
+    """
+
+    def __init__(self, account=None, host="127.0.0.1", port=0, latency=0, ranges=True,
+            zip_downloads=True, bandwidth=0, verbose=False, capacity=0, failure_rate=0):
+        self.state = MockState(account or MockAccount(), latency, ranges, zip_downloads,
+                bandwidth, capacity, failure_rate)
+        self.httpd = ThreadingServer((host, port), MockRequestHandler)
+        self.httpd.state = self.state
+        self.httpd.verbose = verbose
+        self.thread = None
+
+    @property
+    def url(self):
+        return "http://{}:{}".format(*self.httpd.server_address[:2])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, type, value, traceback):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local Stud.IP stand-in server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8123)
+    parser.add_argument("--user", default="student")
+    parser.add_argument("--password", default="secret")
+    parser.add_argument("--courses", type=int, default=5)
+    parser.add_argument("--folders", type=int, default=2, help="Subfolders per folder")
+    parser.add_argument("--depth", type=int, default=1, help="Folder nesting depth")
+    parser.add_argument("--files", type=int, default=5, help="Files per course")
+    parser.add_argument("--file-size", type=int, default=16 * 1024, help="Mean size in bytes")
+    parser.add_argument("--latency", type=float, default=0, help="Delay per request in seconds")
+    parser.add_argument("--bandwidth", type=int, default=0,
+            help="Download speed per connection in bytes/s")
+    parser.add_argument("--capacity", type=int, default=0,
+            help="Concurrent requests handled at full speed, 0 for no limit")
+    parser.add_argument("--failure-rate", type=float, default=0,
+            help="Probability of a request failing with 503")
+    parser.add_argument("--no-ranges", action="store_true", help="Ignore Range headers")
+    parser.add_argument("--no-zip", action="store_true", help="Disable ZIP downloads")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    account = MockAccount(args.user, args.password, courses=args.courses, folders=args.folders,
+            depth=args.depth, files=args.files, file_size=args.file_size, seed=args.seed)
+    server = MockServer(account, args.host, args.port, args.latency, not args.no_ranges,
+            not args.no_zip, args.bandwidth, args.verbose, args.capacity, args.failure_rate)
+    print("Serving {} courses, {} files at {}".format(len(account.courses),
+            len(account.files), server.url))
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -31,10 +31,38 @@ class StopParsing(Exception):
     pass
 
 
+class PageStream:
+    """The text of a page that is still arriving in chunks. Several parsers can read it one
+    after another, each starting at the beginning, and only as much of the page is received as
+    the parsers ask for."""
+
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.received = []
+
+    def __iter__(self):
+        i = 0
+        while True:
+            if i == len(self.received):
+                chunk = next(self.chunks, None)
+                if chunk is None:
+                    return
+                self.received.append(chunk)
+            yield self.received[i]
+            i += 1
+
+
 def create_parser_and_feed(parser_class, html):
+    """Feeds a page to a new parser. The page is either a string or an iterable of strings, e.g.
+    a PageStream, of which no more chunks are taken once the parser raises StopParsing. Note that
+    text can be passed to handle_data() in several parts when fed in chunks."""
     parser = parser_class()
     try:
-        parser.feed(html)
+        if isinstance(html, str):
+            parser.feed(html)
+        else:
+            for chunk in html:
+                parser.feed(chunk)
     except StopParsing:
         pass
 
@@ -89,7 +117,7 @@ class SAMLFormParser(HTMLParser):
 
     def handle_data(self, data):
         if self.in_error_p:
-            self.error = data
+            self.error = (self.error or "") + data
 
     def is_complete(self):
         return all(f in self.form_data for f in SAMLFormParser.fields)
@@ -252,14 +280,23 @@ class FileListParser(HTMLParser):
         self.file_meta = []
         self.current_file_id = None
         self.current_date = ""
+        # Depth of the divs within the error box, if in one
+        self.error_div_depth = 0
+        self.error = None
 
     def handle_starttag(self, tag, attrs):
         State = FileListParser.State
-        if self.state == State.outside and tag == "div":
+        if self.error_div_depth > 0:
+            if tag == "div":
+                self.error_div_depth += 1
+        elif self.state == State.outside and tag == "div":
             attrs = dict(attrs)
             if "id" in attrs and attrs["id"].startswith("file_") and attrs["id"].endswith("_0"):
                 self.state = State.file_0_div
                 self.div_depth = 0
+            elif "class" in attrs and "messagebox_error" in attrs["class"]:
+                self.error_div_depth = 1
+                self.error = ""
         elif self.state == State.file_0_div:
             attrs = dict(attrs)
             if tag == "div":
@@ -274,7 +311,9 @@ class FileListParser(HTMLParser):
 
     def handle_endtag(self, tag):
         State = FileListParser.State
-        if tag == "div" and self.state == State.file_0_div:
+        if tag == "div" and self.error_div_depth > 0:
+            self.error_div_depth -= 1
+        elif tag == "div" and self.state == State.file_0_div:
             if self.div_depth > 0:
                 self.div_depth -= 1
             else:
@@ -298,11 +337,19 @@ class FileListParser(HTMLParser):
 
     def handle_data(self, data):
         State = FileListParser.State
-        if self.state == State.date_td:
+        if self.error_div_depth > 0:
+            self.error += data
+        elif self.state == State.date_td:
             self.current_date += data
 
 def parse_file_list(html):
-    return create_parser_and_feed(FileListParser, html).file_meta
+    """Parses a folder listing and returns the (id, date) pairs of its files. An error shown
+    instead of the files, e.g. if the course could not be selected, raises a ParserError with
+    the text of the error."""
+    parser = create_parser_and_feed(FileListParser, html)
+    if parser.error is not None:
+        raise ParserError(compact(parser.error))
+    return parser.file_meta
 
 
 class FileDetailsParser(HTMLParser):
@@ -316,6 +363,7 @@ class FileDetailsParser(HTMLParser):
         self.div_depth = 0
         self.file = File(None)
         self.current_date = ""
+        self.current_path = ""
 
     def handle_starttag(self, tag, attrs):
         State = FileDetailsParser.State
@@ -358,9 +406,10 @@ class FileDetailsParser(HTMLParser):
         if tag == "div" and self.state in [ State.file_0_div, State.in_open_div ]:
             if self.div_depth > 0:
                 self.div_depth -= 1
-            elif self.file.id is not None:
-                raise StopParsing()
+            else:
+                self.end_file()
         elif tag == "a" and self.state == State.in_folder_a:
+            self.file.path = self.current_path.split(sep=" / ")
             self.state = State.in_open_div
         elif tag == "span" and self.state == State.in_header_span:
             self.state = State.after_header_span
@@ -374,16 +423,21 @@ class FileDetailsParser(HTMLParser):
             except ValueError:
                 pass
 
+    def end_file(self):
+        # Only the first file on the page is of interest
+        if self.file.id is not None:
+            raise StopParsing()
+
     def handle_data(self, data):
         State = FileDetailsParser.State
         if self.state == State.in_folder_a:
-            self.file.path = data.split(sep=" / ")
+            self.current_path += data
         elif self.state == State.in_header_span:
-            self.file.description = data
+            self.file.description = (self.file.description or "") + data
         elif self.state == State.in_origin_td:
             self.current_date += data
         elif self.state == State.in_author_a:
-            self.file.author = data
+            self.file.author = (self.file.author or "") + data
 
 def parse_file_details(course_id, html):
     file = create_parser_and_feed(FileDetailsParser, html).file
@@ -392,3 +446,52 @@ def parse_file_details(course_id, html):
         return file
     else:
         raise ParserError("FileDetails")
+
+
+class FileListingParser(FileDetailsParser):
+    """Reads every file of an expanded folder listing (cmd=all), which shows the same details
+    for each expanded file as the page of a single file. The (id, date) pairs of all files,
+    collapsed ones included, are read by a FileListParser that is passed the same markup."""
+
+    def __init__(self):
+        super().__init__()
+        self.file_list = FileListParser()
+        self.files = []
+
+    @property
+    def error(self):
+        return self.file_list.error
+
+    def handle_starttag(self, tag, attrs):
+        self.file_list.handle_starttag(tag, attrs)
+        super().handle_starttag(tag, attrs)
+
+    def handle_endtag(self, tag):
+        self.file_list.handle_endtag(tag)
+        super().handle_endtag(tag)
+
+    def handle_data(self, data):
+        self.file_list.handle_data(data)
+        super().handle_data(data)
+
+    def end_file(self):
+        if self.file.id and self.file.remote_date:
+            self.files.append(self.file)
+
+        self.state = FileDetailsParser.State.outside
+        self.file = File(None)
+        self.current_date = ""
+        self.current_path = ""
+
+def parse_file_listing(course_id, html):
+    """Parses an expanded folder listing. Returns the (id, date) pairs of all files like
+    parse_file_list(), and the complete File records among them by id. Files whose details
+    are incomplete need to be fetched separately with parse_file_details(). Errors are raised
+    as in parse_file_list()."""
+    parser = create_parser_and_feed(FileListingParser, html)
+    if parser.error is not None:
+        raise ParserError(compact(parser.error))
+    for file in parser.files:
+        file.course = course_id
+    details = dict((file.id, file) for file in parser.files if file.complete())
+    return parser.file_list.file_meta, details
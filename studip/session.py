@@ -1,17 +1,48 @@
-import os, time, threading, ctypes
+import os, sys, re, time, math, threading, ctypes, asyncio, zipfile, shutil, signal, \
+        multiprocessing
 
-from requests import session, RequestException, Timeout
+from requests import session, Request, RequestException, Timeout, ConnectionError
+from requests.exceptions import HTTPError, ChunkedEncodingError
+from requests.cookies import MockRequest, MockResponse, get_cookie_header
+from urllib3.exceptions import ReadTimeoutError
 from urllib.parse import urlencode
 from os import path
 from threading import Thread, Condition, Lock
-from copy import deepcopy
+from copy import copy, deepcopy
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from enum import IntEnum
+from http.client import HTTPMessage
+from http.cookiejar import LWPCookieJar, LoadError
+
+try:
+    import aiohttp
+    from yarl import URL
+except ImportError:
+    aiohttp = None
 
 from .parsers import *
 from .database import SyncMode
 from .util import prompt_choice, ellipsize, escape_file_name, \
         abbreviate_course_name, abbreviate_course_type
-from .async import ThreadPool
+from .concurrency import ThreadPool, AsyncPool, AdaptiveLimit, RetryPolicy, TokenBucket, \
+        ExitThread
+from .connection import create_session, share_session, release_response, SharedCookieJar, \
+        RecordingAdapter, ReplayAdapter
+
+
+CONTENT_RANGE_RE = re.compile(r"bytes\s+(\d+)-")
+
+# Name of the cookie holding the Stud.IP session id
+STUDIP_SESSION_COOKIE = "Seminar_Session"
+
+# Pages are parsed in chunks of this size while they are received
+PAGE_CHUNK_SIZE = 8192
+
+# Errors shown instead of the files of a course if the course was not selected, which happens
+# now and then and is worth retrying, unlike e.g. missing permissions
+UNSELECTED_COURSE_RE = re.compile(r"\b(aus)?gewählt\b|\bselected\b", re.IGNORECASE)
 
 
 class SessionError(Exception):
@@ -21,27 +52,516 @@ class LoginError(SessionError):
     pass
 
 
+def is_overload_response(status_code):
+    """Whether the server, or a gateway in front of it, answered that it is too busy to handle
+    the request or did not get an answer in time."""
+    return status_code in [ 429, 502, 503, 504 ]
+
+
+def is_transient_response(status_code):
+    """Whether an error response might not be repeated if the request is retried."""
+    return status_code == 429 or status_code >= 500
+
+
+def is_timeout(exception):
+    # Newer versions of requests report read timeouts as a ConnectionError
+    return isinstance(exception, Timeout) or (isinstance(exception, ConnectionError)
+            and bool(exception.args) and isinstance(exception.args[0], ReadTimeoutError))
+
+
+def is_transient_failure(response, exception):
+    """Whether a request failed in a way that might not happen again if it is retried: server
+    errors, timeouts and lost connections."""
+    if exception is not None:
+        return isinstance(exception, (Timeout, ConnectionError, ChunkedEncodingError))
+    return is_transient_response(response.status_code)
+
+
+def is_congestion(response, exception):
+    """Whether a request failed in a way that indicates an overloaded server, i.e. timed out or
+    was turned away explicitly. Other transient failures do not say anything about the load."""
+    if exception is not None:
+        return is_timeout(exception)
+    return is_overload_response(response.status_code)
+
+
+def is_transient_error(exception):
+    """Whether a SessionError raised by a pool task was caused by a transient failure, see
+    is_transient_failure()."""
+    cause = exception.__cause__
+    if isinstance(cause, HTTPError) and cause.response is not None:
+        return is_transient_response(cause.response.status_code)
+    if aiohttp is not None:
+        if isinstance(cause, aiohttp.ClientResponseError):
+            return is_transient_response(cause.status)
+        if isinstance(cause, (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError)):
+            return True
+    return isinstance(cause, (Timeout, ConnectionError, ChunkedEncodingError,
+            asyncio.TimeoutError))
+
+
+@contextmanager
+def streamed_page(r):
+    """Makes the body of a response requested with stream=True available as a PageStream. Only
+    the part of the page read by parsers is received, the rest is dropped when the block ends."""
+    try:
+        if r.encoding is None:
+            # Without a charset, requests guesses the encoding from the complete page
+            yield PageStream([ r.text ])
+        else:
+            yield PageStream(r.iter_content(PAGE_CHUNK_SIZE, decode_unicode=True))
+    finally:
+        release_response(r)
+
+
+class ParsedResponse:
+    """Result of a pool request that was parsed on the worker. result() returns what the parser
+    returned or raises its ParserError."""
+
+    def __init__(self, status_code, url, headers, parsed=None, error=None):
+        self.status_code = status_code
+        self.url = url
+        self.headers = headers
+        self.parsed = parsed
+        self.error = error
+
+    def result(self):
+        if self.error is not None:
+            raise self.error
+        return self.parsed
+
+
 def raise_fetch_error(page, e):
     raise SessionError("Unable to fetch {}: {}".format(page, str(e)))
 
 
-class SessionPool(ThreadPool):
-    def __init__(self, n_threads, cookies):
-        super().__init__(n_threads, { "cookies": cookies })
+class RequestTasks:
+    """Tasks of SessionPool and AsyncSessionPool."""
+
+    def defer_request(self, method, *args, cookies=None, parser=None, **kwargs):
+        """Defers a request, optionally made with the cookies of another session. If a parser
+        function is given along with its leading arguments as a tuple, it is called with the
+        page while it is received and the request yields a ParsedResponse."""
+        self.defer({ "method": method, "args": args, "kwargs": kwargs, "cookies": cookies,
+                "parser": parser })
+
+
+class SessionPool(RequestTasks, ThreadPool):
+    """Runs requests on worker threads. All workers share the connection pool and the cookies
+    of the given session, so that connections are kept alive across tasks and workers. A request
+    can be given the cookie jar of another session to run in that session instead."""
+
+    def __init__(self, n_threads, http, limit=None, retry=None, ordered=False):
+        self.http = http
+        super().__init__(n_threads, limit=limit, retry=retry, ordered=ordered)
 
     def init_thread(self, local_state):
-        session = requests.session()
-        session.cookies = local_state["cookies"]
-        local_state["session"] = session
+        local_state["session"] = share_session(self.http)
+        local_state["cookie_sessions"] = {}
+
+    def is_congested(self, result, exception):
+        return is_congestion(result, exception)
 
-    def cleanup_thread(self, local_state):
-        local_state["session"].close()
+    def is_retryable(self, result, exception):
+        return is_transient_failure(result, exception)
 
     def execute_task(self, local_state, task):
-        return local_state["session"].request(task["method"], *task["args"], **task["kwargs"])
+        cookies = task["cookies"]
+        if cookies is None:
+            session = local_state["session"]
+        else:
+            sessions = local_state["cookie_sessions"]
+            if id(cookies) not in sessions:
+                sessions[id(cookies)] = share_session(self.http, cookies)
+            session = sessions[id(cookies)]
+
+        if task["parser"] is None:
+            return session.request(task["method"], *task["args"], **task["kwargs"])
+
+        parser, parser_args = task["parser"]
+        r = session.request(task["method"], *task["args"], stream=True, **task["kwargs"])
+        with streamed_page(r) as page:
+            result = ParsedResponse(r.status_code, r.url, r.headers)
+            if r.status_code < 400:
+                try:
+                    result.parsed = parser(*parser_args, page)
+                except ParserError as e:
+                    result.error = e
+        return result
+
+
+
+def ignore_interrupts():
+    # Parse processes are interrupted along with the main process, which cleans up after them
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def diff_file_list(file_list, db_file_dict):
+    """Splits a course's file list into the ids of files that are not yet known to the database
+    and those that have changed remotely."""
+    new_files = [ file_id for file_id, _ in file_list if file_id not in db_file_dict ]
+    updated_files = [ file_id for file_id, date in file_list
+            if file_id in db_file_dict and db_file_dict[file_id].remote_date != date ]
+    return new_files, updated_files
+
+
+class CourseListPool(ThreadPool):
+    """Lists several courses at once. Stud.IP keeps the selected course as server-side session
+    state, so each worker thread logs in with its own session and handles selecting a course,
+    listing its files and fetching their details as a single unit. The connection pool is
+    shared with the main session nevertheless. Courses are returned in the order they were
+    deferred in."""
+
+    def __init__(self, n_threads, session):
+        self.session = session
+        super().__init__(n_threads, ordered=True)
+
+    def init_thread(self, local_state):
+        local_state["http"] = self.session.open_course_session()
+
+    def execute_task(self, local_state, task):
+        http, course = local_state["http"], task["course"]
+        listing = self.session.list_course_files(http, course)
+        if listing is None:
+            return None
+        file_list, details = listing
+        new_files, updated_files = diff_file_list(file_list, task["known_files"])
+
+        files = []
+        for file_id in new_files + updated_files:
+            if file_id in details:
+                files.append(details[file_id])
+                continue
+            if self.cancelled.is_set():
+                raise ExitThread()
+            try:
+                files.append(self.session.fetch_page(http,
+                        self.session.folder_url(course) + "&open=" + file_id,
+                        parse_file_details, course.id))
+            except RequestException as e:
+                raise_fetch_error("file details", e)
+            except ParserError:
+                raise SessionError("Unable to parse file details")
+
+        return course, new_files, updated_files, details, files
+
+    def defer_course(self, course, known_files):
+        self.defer({ "course": course, "known_files": known_files })
+
+
+def partial_file_path(file_path):
+    """Location of the incomplete download for a file in .studip/files."""
+    return path.join(path.dirname(file_path), "." + path.basename(file_path) + ".part")
+
+
+def is_fetched(file, file_path):
+    """Whether file_path holds the complete download of file. Completed downloads get the remote
+    date of the file as their modification time before they are moved into place, which tells
+    them apart from downloads of earlier versions even if the database was not updated."""
+    if file.remote_date is None or not path.isfile(file_path):
+        return False
+    return int(path.getmtime(file_path)) == int(time.mktime(file.remote_date.timetuple()))
+
+
+def resumed_offset(status_code, headers, offset):
+    """Where the body of the response to a request for a file from offset on starts: at offset
+    if the server honored the range, at 0 if it sent the whole file instead. None means that the
+    response is of no use and the file has to be requested again without a range."""
+    if status_code == 206:
+        match = CONTENT_RANGE_RE.match(headers.get("Content-Range", ""))
+        if match and int(match.group(1)) == offset:
+            return offset
+    elif status_code == 200:
+        # Ranges are not supported, the server sends the whole file
+        return 0
+    return None
+
+
+def open_partial_file(part_path, offset):
+    """Opens the partial download of a file for writing from offset on. Files are downloaded
+    next to their destination and only moved there by finish_download(), so that an interrupted
+    download never shows up as a fetched file. The partial file is kept on failure so that the
+    next fetch can resume it."""
+    writer = open(part_path, "r+b" if offset > 0 else "wb")
+    writer.seek(offset)
+    writer.truncate()
+    return writer
+
 
-    def defer_request(self, method, *args, **kwargs):
-        self.defer({ "method": method, "args": args, "kwargs": kwargs })
+def finish_download(file, part_path, file_path):
+    """Moves a complete download into place, after setting its modification time to the remote
+    date of the file (see is_fetched())."""
+    file.local_date = file.remote_date
+    timestamp = time.mktime(file.local_date.timetuple())
+    os.utime(part_path, (timestamp, timestamp))
+    os.replace(part_path, file_path)
+
+
+class FetchTasks:
+    """Tasks of FetchPool and AsyncFetchPool. Each task is written to disk by the pool and the
+    fetched File object is returned along with the offset the download was resumed at, so that
+    the database can be updated from the thread that owns the connection. If a token bucket is
+    given, all downloads together stay below its rate in bytes per second."""
+
+    # Responses are streamed to disk in chunks of this size instead of being held in memory
+    chunk_size = 64 * 1024
+
+    def is_congested(self, result, exception):
+        # Download times depend on the file sizes, downloads therefore use a fixed limit
+        return False
+
+    def is_retryable(self, result, exception):
+        return isinstance(exception, SessionError) and is_transient_error(exception)
+
+    def start_offset(self, task, part_path):
+        """The offset to request the file of a task from. A retried download resumes where the
+        failed attempt stopped."""
+        offset = task["offset"]
+        if task.get("attempted") and path.isfile(part_path):
+            offset = path.getsize(part_path)
+        task["attempted"] = True
+        return offset
+
+    def defer_fetch(self, file, file_path, url, offset=0):
+        self.defer({ "file": file, "path": file_path, "url": url, "offset": offset })
+
+
+class FetchPool(FetchTasks, SessionPool):
+    """Downloads files on worker threads, see FetchTasks."""
+
+    def __init__(self, n_threads, http, bucket=None, retry=None):
+        self.bucket = bucket
+        super().__init__(n_threads, http, retry=retry)
+
+    def request_file(self, session, url, offset):
+        """Requests a file, resuming at offset if the server supports range requests. Returns
+        the response and the offset its body starts at."""
+        if offset > 0:
+            r = session.get(url, stream=True, headers={ "Range": "bytes={}-".format(offset) })
+            body_offset = resumed_offset(r.status_code, r.headers, offset)
+            if body_offset is not None:
+                return r, body_offset
+            r.close()
+            # Retrying keeps the partial file, starting over would not
+            if is_transient_response(r.status_code):
+                r.raise_for_status()
+
+        r = session.get(url, stream=True)
+        r.raise_for_status()
+        return r, 0
+
+    def execute_task(self, local_state, task):
+        file, file_path, url = task["file"], task["path"], task["url"]
+        part_path = partial_file_path(file_path)
+        try:
+            r, offset = self.request_file(local_state["session"], url,
+                    self.start_offset(task, part_path))
+            try:
+                with open_partial_file(part_path, offset) as writer:
+                    for chunk in r.iter_content(self.chunk_size):
+                        writer.write(chunk)
+                        # Stop between chunks if the pool is cancelled, the partial file can be
+                        # resumed by the next fetch
+                        if self.bucket:
+                            self.cancelled.wait(self.bucket.reserve(len(chunk)))
+                        if self.cancelled.is_set():
+                            raise ExitThread()
+            finally:
+                r.close()
+        except RequestException as e:
+            raise SessionError("Unable to download file {}: {}".format(file.name, e)) from e
+
+        finish_download(file, part_path, file_path)
+        return file, offset
+
+
+def archive_member_name(info):
+    """Name of a ZIP archive member. zipfile decodes names that are not flagged as UTF-8 as
+    CP437, but many archivers write UTF-8 without setting the flag."""
+    if info.flag_bits & 0x800:
+        return info.filename
+    try:
+        return info.filename.encode("cp437").decode("utf-8")
+    except UnicodeError:
+        return info.filename
+
+
+def match_archive_members(members, files):
+    """Pairs the members of a course archive with the files they contain, by file name and
+    folder path. The archive's folder hierarchy might start at a different level than the paths
+    in the database, so only the part both have in common needs to agree. Files that more than
+    one member could belong to are left out, they have to be downloaded separately."""
+    files_by_name = {}
+    for file in files:
+        file_name = file.name + ("." + file.extension if file.extension else "")
+        files_by_name.setdefault(file_name, []).append(file)
+
+    def same_folder(file_path, member_path):
+        common = min(len(file_path), len(member_path))
+        return file_path[len(file_path) - common:] == member_path[len(member_path) - common:]
+
+    matches = {}
+    ambiguous = set()
+    for info in members:
+        member_path = archive_member_name(info).split("/")
+        if not member_path[-1]:
+            continue # Folder entry
+        candidates = [ file for file in files_by_name.get(member_path[-1], [])
+                if same_folder(file.path, member_path[:-1]) ]
+        for file in candidates:
+            if len(candidates) > 1 or file.id in matches:
+                ambiguous.add(file.id)
+            matches[file.id] = (file, info)
+
+    return [ match for file_id, match in matches.items() if file_id not in ambiguous ]
+
+
+class AsyncResponse:
+    """The parts of a requests.Response that consumers of AsyncSessionPool rely on."""
+
+    def __init__(self, status_code, url, headers, text):
+        self.status_code = status_code
+        self.url = url
+        self.headers = headers
+        self.text = text
+
+
+def store_cookies(jar, url, headers):
+    """Stores the cookies set by an aiohttp response to a request for url in a requests jar."""
+    message = HTTPMessage()
+    for value in headers.getall("Set-Cookie", []):
+        message["Set-Cookie"] = value
+    jar.extract_cookies(MockResponse(message), MockRequest(Request("GET", url).prepare()))
+
+
+class AsyncSessionPool(RequestTasks, AsyncPool):
+    """Drop-in replacement for SessionPool that runs all requests on one asyncio event loop
+    through a shared aiohttp session, allowing hundreds of requests in flight without a thread
+    for each of them.
+
+    Cookies are not kept by aiohttp but taken from and stored in the requests cookie jar of the
+    session, or of the jar given with a request, so both engines always see the same cookies.
+    Redirects are followed by the pool itself for that reason."""
+
+    max_redirects = 10
+
+    def __init__(self, max_tasks, http, limit=None, retry=None, ordered=False):
+        self.cookies = http.cookies
+        self.timeout = http.timeout
+        super().__init__(max_tasks, limit, retry, ordered)
+
+    async def init_loop(self):
+        # Like the requests session, only waiting for the server is limited, not whole downloads
+        connector = aiohttp.TCPConnector(limit=self.max_tasks)
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=self.timeout,
+                sock_read=self.timeout)
+        self.http = aiohttp.ClientSession(cookie_jar=aiohttp.DummyCookieJar(),
+                connector=connector, timeout=timeout)
+
+    async def cleanup_loop(self):
+        await self.http.close()
+
+    async def request(self, method, url, cookies=None, headers={}, **kwargs):
+        """Makes a request with the cookies of a requests cookie jar and returns the response,
+        which the caller has to release."""
+        cookies = self.cookies if cookies is None else cookies
+        for _ in range(self.max_redirects + 1):
+            cookie_header = get_cookie_header(cookies, Request(method, url).prepare())
+            r = await self.http.request(method, url, allow_redirects=False,
+                    headers=dict(headers, Cookie=cookie_header) if cookie_header else headers,
+                    **kwargs)
+            store_cookies(cookies, url, r.headers)
+            if r.status not in [ 301, 302, 303, 307, 308 ] or "Location" not in r.headers:
+                return r
+
+            r.release()
+            url = str(r.url.join(URL(r.headers["Location"])))
+            # Like requests and browsers, turn POST into GET after most redirects
+            if r.status == 303 or (r.status in [ 301, 302 ] and method == "POST"):
+                method = "GET"
+                kwargs.pop("data", None)
+        raise SessionError("Unable to fetch {}: Too many redirects".format(url))
+
+    async def execute_task(self, task):
+        url = task["args"][0]
+        try:
+            r = await self.request(task["method"], *task["args"], cookies=task["cookies"],
+                    **task["kwargs"])
+            async with r:
+                text = await r.text()
+                if task["parser"] is None:
+                    return AsyncResponse(r.status, str(r.url), r.headers, text)
+        except asyncio.TimeoutError as e:
+            raise SessionError("Unable to fetch {}: Timeout".format(url)) from e
+        except aiohttp.ClientError as e:
+            raise SessionError("Unable to fetch {}: {}".format(url, e)) from e
+
+        # Parsing blocks the event loop, so pages are received completely first
+        parser, parser_args = task["parser"]
+        result = ParsedResponse(r.status, str(r.url), r.headers)
+        if r.status < 400:
+            try:
+                result.parsed = parser(*parser_args, text)
+            except ParserError as e:
+                result.error = e
+        return result
+
+    def is_congested(self, result, exception):
+        # Network errors are reported as SessionErrors caused by the aiohttp exception. Only
+        # timeouts and explicit overload responses say anything about the server load.
+        if exception is not None:
+            return isinstance(exception.__cause__, asyncio.TimeoutError)
+        return is_overload_response(result.status_code)
+
+    def is_retryable(self, result, exception):
+        if exception is not None:
+            return isinstance(exception, SessionError) and is_transient_error(exception)
+        return is_transient_response(result.status_code)
+
+
+class AsyncFetchPool(FetchTasks, AsyncSessionPool):
+    """Asynchronous counterpart to FetchPool, see there."""
+
+    def __init__(self, max_tasks, http, bucket=None, retry=None):
+        self.bucket = bucket
+        super().__init__(max_tasks, http, retry=retry)
+
+    async def request_file(self, url, offset):
+        if offset > 0:
+            r = await self.request("GET", url, headers={ "Range": "bytes={}-".format(offset) })
+            body_offset = resumed_offset(r.status, r.headers, offset)
+            if body_offset is not None:
+                return r, body_offset
+            r.release()
+            if is_transient_response(r.status):
+                r.raise_for_status()
+
+        r = await self.request("GET", url)
+        try:
+            r.raise_for_status()
+        except BaseException:
+            r.release()
+            raise
+        return r, 0
+
+    async def execute_task(self, task):
+        file, file_path, url = task["file"], task["path"], task["url"]
+        part_path = partial_file_path(file_path)
+        try:
+            r, offset = await self.request_file(url, self.start_offset(task, part_path))
+            try:
+                with open_partial_file(part_path, offset) as writer:
+                    async for chunk in r.content.iter_chunked(self.chunk_size):
+                        writer.write(chunk)
+                        if self.bucket:
+                            await asyncio.sleep(self.bucket.reserve(len(chunk)))
+            finally:
+                r.release()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise SessionError("Unable to download file {}: {}".format(file.name, e)) from e
+
+        finish_download(file, part_path, file_path)
+        return file, offset
 
 
 class Session:
@@ -52,68 +572,323 @@ class Session:
         return self.config["server", "studip_base"] + url
 
 
-    def __init__(self, config, db, user_name, password, sync_dir):
+    def __init__(self, config, db, user_name, password, sync_dir, cookie_file=None,
+            record_dir=None, replay_dir=None, latency_scale=1.0):
         self.db = db
         self.config = config
         self.sync_dir = sync_dir
+        self.user_name = user_name
+        self.password = password
+        self.parse_pool = None
+
+        engine = self.config["connection", "engine"]
+        if engine not in [ "threads", "asyncio" ]:
+            sys.stderr.write("Unknown connection engine \"{}\", using threads\n".format(engine))
+        elif engine == "asyncio" and aiohttp is None:
+            sys.stderr.write("The asyncio engine requires aiohttp, using threads\n")
+        self.use_asyncio = engine == "asyncio" and aiohttp is not None
+
+        # Recording and replaying hooks into the transport adapters of requests
+        if self.use_asyncio and (record_dir or replay_dir):
+            sys.stderr.write("Recording and replaying requests requires the threads engine, "
+                    "using threads\n")
+            self.use_asyncio = False
 
-        self.http = requests.session()
+        self.retry = RetryPolicy(int(self.config["connection", "retries"]),
+                float(self.config["connection", "retry_delay"]))
 
+        # One keep-alive pool serves the main session and all workers, so it needs to hold a
+        # connection per worker of the largest pool plus one for the main thread
+        pool_size = max(int(self.config["connection", key]) for key in
+                [ "max_update_concurrency", "fetch_concurrency", "list_concurrency" ]) + 1
+        if replay_dir:
+            adapter = ReplayAdapter(replay_dir, latency_scale)
+        elif record_dir:
+            adapter = RecordingAdapter(record_dir, pool_maxsize=pool_size)
+        else:
+            adapter = None
+        # Without a timeout, a stalled server would neither be retried nor make the limit of
+        # concurrent requests back off
+        timeout = float(self.config["connection", "timeout"]) or None
+        self.http = create_session(pool_size, adapter=adapter, timeout=timeout)
+
+        # Reuse the session of an earlier run if it is still valid. Otherwise, the single sign-on
+        # cookies loaded from the file might still spare us from sending the credentials.
+        if not (cookie_file and self.load_cookies(cookie_file) and self.session_valid()):
+            self.login(self.http)
+
+
+    def load_cookies(self, file_name):
+        jar = LWPCookieJar(file_name)
+        try:
+            jar.load(ignore_discard=True)
+        except (IOError, LoadError):
+            return False
+        for cookie in jar:
+            self.http.cookies.set_cookie(cookie)
+        return True
+
+
+    def save_cookies(self, file_name):
+        """Saves the session cookies to a file only readable by the current user."""
+        jar = LWPCookieJar(file_name)
+        for cookie in self.http.cookies:
+            jar.set_cookie(cookie)
+        os.close(os.open(file_name, os.O_WRONLY | os.O_CREAT, 0o600))
+        os.chmod(file_name, 0o600)
+        jar.save(ignore_discard=True)
+
+
+    def session_valid(self):
+        """Cheaply checks whether the current cookies belong to a logged-in Stud.IP session. An
+        expired session is redirected to the login page instead of showing the course list."""
         try:
-            r = self.http.get(self.studip_url("/studip/index.php?again=yes&sso=shib"))
+            r = self.http.get(self.studip_url("/studip/dispatch.php/my_courses"),
+                    allow_redirects=False, stream=True)
+        except RequestException:
+            return False
+        # The semester list comes early on the page, the course list is not needed
+        with streamed_page(r) as page:
+            if r.status_code != 200:
+                return False
+            try:
+                return bool(parse_semester_list(page).semesters)
+            except (ParserError, RequestException):
+                return False
+
+
+    def request_pool(self, concurrency, max_concurrency=None, ordered=False):
+        """Creates a pool that starts with concurrency requests in flight and adapts that number
+        to the server load, up to max_concurrency."""
+        limit = AdaptiveLimit(concurrency, maximum=max_concurrency)
+        pool_class = AsyncSessionPool if self.use_asyncio else SessionPool
+        return pool_class(limit.maximum, self.http, limit, self.retry, ordered)
+
+
+    def fetch_pool(self, concurrency, bucket=None):
+        """Creates a pool downloading up to concurrency files at once. If a token bucket is
+        given, it limits the bandwidth of all downloads together. Failed downloads are retried
+        from where they stopped."""
+        pool_class = AsyncFetchPool if self.use_asyncio else FetchPool
+        return pool_class(concurrency, self.http, bucket, self.retry)
+
+
+    def fetch_page(self, http, url, parser, *args):
+        """Requests a page and returns the result of parser(*args, page). The page is parsed
+        while it is received, and the rest of it is not received once the parser has found what
+        it needs. Error responses raise a RequestException."""
+        with streamed_page(self.request(http, "GET", url, stream=True)) as page:
+            return parser(*args, page)
+
+
+    def request(self, http, method, url, **kwargs):
+        """Makes a request, retrying it after timeouts, connection errors and overload
+        responses. Error responses that remain raise a RequestException, as their pages would
+        otherwise be mistaken for e.g. an empty file list."""
+        r = self.retry.call(lambda: http.request(method, url, **kwargs), is_transient_failure)
+        r.raise_for_status()
+        return r
+
+
+    def login(self, http):
+        try:
+            r = self.request(http, "GET", self.studip_url("/studip/index.php?again=yes&sso=shib"))
         except RequestException as e:
             raise_fetch_error("login page", e)
 
+        # If the SSO server still knows the session from its cookies, it skips the login form
+        # and answers with the SAML form right away
         try:
-            form_data = parse_login_form(r.text)
+            form_data = parse_saml_form(r.text)
         except ParserError:
-            raise LoginError("Error parsing login page")
-
-        try:
-            r = self.http.post(
-                    self.sso_url(form_data.post_url),
-                    data = {
-                        "j_username": user_name,
-                        "j_password": password,
-                        "uApprove.consent-revocation": "",
-                        "_eventId_proceed": ""
-                    }
-                )
+            try:
+                form_data = parse_login_form(r.text)
+            except ParserError:
+                raise LoginError("Error parsing login page")
+
+            try:
+                r = self.request(http, "POST",
+                        self.sso_url(form_data.post_url),
+                        data = {
+                            "j_username": self.user_name,
+                            "j_password": self.password,
+                            "uApprove.consent-revocation": "",
+                            "_eventId_proceed": ""
+                        }
+                    )
+            except RequestException as e:
+                raise_fetch_error("login confirmation page", e)
+
+            try:
+                form_data = parse_saml_form(r.text)
+            except ParserError as e:
+                message = "Login failed"
+                if e.message:
+                    message += ": " + e.message
+                raise LoginError(message)
+
+        try:
+            r = self.request(http, "POST", self.studip_url("/Shibboleth.sso/SAML2/POST"),
+                    data=form_data)
         except RequestException as e:
-            raise_fetch_error("login confirmation page", e)
+            raise_fetch_error("login page", e)
+
+
+    def open_course_session(self):
+        """Logs into Stud.IP a second time, creating a session with its own server-side state,
+        most importantly the currently selected course. The single sign-on cookies are shared
+        with the main session so that no credentials need to be sent, the connection pool is
+        shared as well."""
+        cookies = SharedCookieJar()
+        for cookie in self.http.cookies:
+            if cookie.name != STUDIP_SESSION_COOKIE:
+                cookies.set_cookie(copy(cookie))
+        http = share_session(self.http, cookies)
+        self.login(http)
+        return http
+
 
+    def select_course(self, http, course):
+        course_url = self.studip_url("/studip/seminar_main.php?auswahl=" + course.id)
         try:
-            form_data = parse_saml_form(r.text)
-        except ParserError as e:
-            message = "Login failed"
-            if e.message:
-                message += ": " + e.message
-            raise LoginError(message)
+            http.get(course_url, timeout=(None, 0.001))
+        except (KeyboardInterrupt, SystemExit):
+            raise
+        except Timeout:
+            pass
+        except RequestException as e:
+            # Newer versions of requests report the read timeout as a ConnectionError
+            if not (e.args and isinstance(e.args[0], ReadTimeoutError)):
+                raise SessionError("Unable to set course: {}".format(str(e)))
+
+
+    def folder_url(self, course):
+        return self.studip_url("/studip/folder.php?cid=" + course.id + "&cmd=all")
+
+
+    def list_course_files(self, http, course):
+        """Selects the course and returns the (id, date) pairs of all its files, along with the
+        File records of those whose details are complete in the listing by id. Only the other
+        files need their details fetched separately. Selecting the course can fail unnoticed,
+        Stud.IP then shows an error instead of the files and both steps are retried. Returns
+        None if the files cannot be listed, after reporting why, so that the course is skipped."""
+        # The listing is needed before anything else can be done for the course, so handing it
+        # to the parse pool would only add to the wait
+        def select_and_list():
+            self.select_course(http, course)
+            return self.fetch_page(http, self.folder_url(course), parse_file_listing, course.id)
+
+        def is_unselected(result, exception):
+            return isinstance(exception, ParserError) and exception.message is not None \
+                    and UNSELECTED_COURSE_RE.search(exception.message) is not None
 
         try:
-            r = self.http.post(self.studip_url("/Shibboleth.sso/SAML2/POST"), form_data)
+            return self.retry.call(select_and_list, is_unselected)
         except RequestException as e:
-            raise_fetch_error("login page", e)
+            raise_fetch_error("file list", e)
+        except ParserError as e:
+            sys.stderr.write("Skipping {} {}: {}\n".format(course.type, course.name,
+                    e.message or "Unable to parse file list"))
+            return None
+
+
+    def print_course_summary(self, course, new_files, updated_files):
+        if self.last_course_synced:
+            print()
+
+        if len(new_files) > 0:
+            new_files_str = ("" if self.last_course_synced else "\n") + str(len(new_files))
+            self.last_course_synced = True
+        else:
+            new_files_str = "No"
+            self.last_course_synced = False
+
+        updated_files_str = ""
+        if len(updated_files) > 0:
+            updated_files_str = ", {} updated ".format(len(updated_files))
+
+        print("{} new{} file(s) for {} {} ".format(new_files_str, updated_files_str,
+                course.type, course.name))
+
+
+    def store_course_files(self, course, files, new_files, listed_files):
+        """Stores the files of a course in one batch and records the course as finished, all in
+        a single transaction. Files whose details were fetched separately, i.e. that are not
+        among the ids in listed_files, are reported."""
+        new_files = set(new_files)
+        fetched_files = [ file for file in files if file.id not in listed_files ]
+        for i, file in enumerate(fetched_files):
+            print("Fetched metadata for file {}/{}: ".format(i+1, len(fetched_files)), end="",
+                    flush=True)
+            print(" " + file.description if file.complete() else " <bad format>")
+
+        new, updated = [], []
+        for file in files:
+            if file.complete():
+                (new if file.id in new_files else updated).append(file)
+
+        self.store_times.append((len(new) + len(updated), self.db.store_files(new, updated)))
+        self.finish_course(course)
+
+
+    def parse_async(self, parser, *args):
+        """Starts parsing a page with one of the parse_* functions and returns a function that
+        waits for the result. Pages are parsed in the parse pool if there is one, otherwise the
+        returned function parses the page itself."""
+        if self.parse_pool is None:
+            return lambda: parser(*args)
+        return self.parse_pool.apply_async(parser, args).get
+
+
+    def start_parse_pool(self):
+        """Starts the pool of processes that parses file details, if configured and not started
+        yet, and returns whether there is one. The pool is only started once there are pages to
+        parse, by then worker threads are running, so its processes are spawned instead of forked,
+        which is unsafe with threads."""
+        n_processes = int(self.config["connection", "parse_processes"])
+        if self.parse_pool is None and n_processes > 0:
+            context = multiprocessing.get_context("spawn")
+            self.parse_pool = context.Pool(n_processes, ignore_interrupts)
+        return self.parse_pool is not None
 
 
     def update_metadata(self):
+        """Updates the course list and the files of all courses to synchronize. A parse pool
+        started during the update is shut down at its end."""
+        try:
+            self.sync_metadata()
+        finally:
+            if self.parse_pool is not None:
+                self.parse_pool.terminate()
+                self.parse_pool.join()
+                self.parse_pool = None
+
+
+    def sync_metadata(self):
         url = self.studip_url("/studip/dispatch.php/my_courses/set_semester")
         try:
-            overview_page = self.http.post(url, data={ "sem_select": "current" }).text
+            r = self.request(self.http, "POST", url, data={ "sem_select": "current" },
+                    stream=True)
         except RequestException as e:
             raise_fetch_error("overview page", e)
 
-        try:
-            semester_list = parse_semester_list(overview_page)
-        except ParserError:
-            raise SessionError("Unable to parse overview page")
+        # Both parsers stop at the end of their part of the page
+        with streamed_page(r) as overview_page:
+            try:
+                semester_list = parse_semester_list(overview_page)
+            except ParserError:
+                raise SessionError("Unable to parse overview page")
+            except RequestException as e:
+                raise_fetch_error("overview page", e)
 
-        self.db.update_semester_list(semester_list.semesters)
+            self.db.update_semester_list(semester_list.semesters)
 
-        try:
-            remote_courses = parse_course_list(overview_page)
-        except ParserError:
-            raise SessionError("Unable to parse course list")
+            try:
+                remote_courses = parse_course_list(overview_page)
+            except ParserError:
+                raise SessionError("Unable to parse course list")
+            except RequestException as e:
+                raise_fetch_error("overview page", e)
 
         remote_course_ids = [course.id for course in remote_courses]
 
@@ -144,78 +919,248 @@ class Session:
             self.db.add_course(course)
 
         sync_courses = self.db.list_courses(full=True, select_sync_no=False)
-        last_course_synced = False
+
+        # Courses finished by an interrupted update do not need to be listed again
+        max_age = timedelta(seconds=int(self.config["connection", "checkpoint_max_age"]))
+        finished_courses = self.db.list_update_checkpoints(datetime.now() - max_age)
+        remaining_courses = [ c for c in sync_courses if c.id not in finished_courses ]
+        if len(remaining_courses) < len(sync_courses):
+            print("Resuming interrupted update, skipping {} course(s)".format(
+                    len(sync_courses) - len(remaining_courses)))
+            sync_courses = remaining_courses
+
+        self.last_course_synced = False
+        # (number of files, seconds) for every course stored
+        self.store_times = []
         db_files = self.db.list_files(full=True, select_sync_yes=True,
                 select_sync_metadata_only=True, select_sync_no=False)
         db_file_dict = dict((f.id, f) for f in db_files)
 
+        list_concurrency = min(int(self.config["connection", "list_concurrency"]),
+                len(sync_courses))
+        if list_concurrency > 1:
+            self.update_courses_concurrently(sync_courses, db_file_dict, list_concurrency)
+        else:
+            self.update_courses(sync_courses, db_file_dict)
+
+        n_stored = sum(n for n, _ in self.store_times)
+        if n_stored > 0:
+            print("Stored {} file(s) in {} batch(es) in {:.2f}s, slowest batch {:.2f}s".format(
+                    n_stored, len(self.store_times), sum(t for _, t in self.store_times),
+                    max(t for _, t in self.store_times)))
+
+        self.db.clear_update_checkpoints()
+
+
+    def finish_course(self, course):
+        """Records that a course is up to date, so that it is skipped if the update fails later
+        on and is run again."""
+        self.db.add_update_checkpoint(course, datetime.now())
+        self.db.commit()
+
+
+    def update_courses(self, sync_courses, db_file_dict):
+        """Lists the courses one after another and fetches the details of their new and updated
+        files through a request pool. Up to pipeline_depth courses are in flight at once, so that
+        the next courses are listed while the details of the current one are fetched. As the
+        selected course is part of the Stud.IP session state, each course in flight needs its
+        own session, the first one being the main session. Files are stored by the calling
+        thread, one course after another."""
         concurrency = int(self.config["connection", "update_concurrency"])
-        with SessionPool(concurrency, self.http.cookies) as pool:
-            for course in sync_courses:
-                course_url = self.studip_url("/studip/seminar_main.php?auswahl=" + course.id)
-                folder_url = self.studip_url("/studip/folder.php?cid=" + course.id + "&cmd=all")
+        max_concurrency = int(self.config["connection", "max_update_concurrency"])
+        depth = max(1, int(self.config["connection", "pipeline_depth"]))
+
+        courses = deque(sync_courses)
+        in_flight = deque()
+        free_sessions = [ self.http ]
+        outstanding = 0
+        with self.request_pool(concurrency, max_concurrency, ordered=True) as pool:
+            while courses or in_flight:
+                # Another session is only worth its login if there are details to wait for
+                while courses and (free_sessions or (outstanding and len(in_flight) < depth)):
+                    http = free_sessions.pop() if free_sessions else self.open_course_session()
+                    course = courses.popleft()
+                    listing = self.list_course_files(http, course)
+                    if listing is None:
+                        free_sessions.append(http)
+                        continue
+                    file_list, details = listing
+                    new_files, updated_files = diff_file_list(file_list, db_file_dict)
+
+                    # Only files the listing does not fully describe need a request of their own
+                    cookies = None if http is self.http else http.cookies
+                    files_to_fetch = [ file_id for file_id in new_files + updated_files
+                            if file_id not in details ]
+                    # Details are parsed on the workers while they are received, unless there is
+                    # a parse pool
+                    stream_details = not (files_to_fetch and self.start_parse_pool())
+                    parser = (parse_file_details, (course.id,)) if stream_details else None
+                    for file_id in files_to_fetch:
+                        pool.defer_request("GET", self.folder_url(course) + "&open=" + file_id,
+                                cookies=cookies, parser=parser)
+                    outstanding += len(files_to_fetch)
+                    in_flight.append((course, new_files, updated_files, details, files_to_fetch,
+                            stream_details, http))
+
+                # Skipped courses leave nothing in flight
+                if not in_flight:
+                    continue
+
+                # The pool is ordered, so the next results belong to the oldest course
+                course, new_files, updated_files, details, files_to_fetch, stream_details, \
+                        http = in_flight.popleft()
+                self.print_course_summary(course, new_files, updated_files)
+
+                # Files are stored once all pages of the course are in
+                outstanding -= len(files_to_fetch)
+                parsed_files = [ (lambda file=details[file_id]: file)
+                        for file_id in new_files + updated_files if file_id in details ]
+                for _ in files_to_fetch:
+                    request = pool.next_result()
+                    if request.status_code >= 400:
+                        raise SessionError("Unable to fetch file details: HTTP status {}".format(
+                                request.status_code))
+                    if stream_details:
+                        parsed_files.append(request.result)
+                    else:
+                        parsed_files.append(self.parse_async(parse_file_details, course.id,
+                                request.text))
 
                 try:
-                    self.http.get(course_url, timeout=(None, 0.001))
-                except (KeyboardInterrupt, SystemExit):
-                    raise
-                except Timeout:
-                    pass
-                except RequestException as e:
-                    raise SessionError("Unable to set course: {}".format(str(e)))
-
-                r = self.http.get(folder_url)
-                try:
-                    file_list = parse_file_list(r.text)
+                    files = [ parsed_file() for parsed_file in parsed_files ]
                 except ParserError:
-                    raise SessionError("Unable to parse file list")
+                    raise SessionError("Unable to parse file details")
 
-                if last_course_synced:
-                    print()
+                self.store_course_files(course, files, new_files, details)
+                free_sessions.append(http)
 
-                new_files = [ file_id for file_id, _ in file_list if file_id not in db_file_dict ]
-                updated_files = [ file_id for file_id, date in file_list
-                        if file_id  in db_file_dict and db_file_dict[file_id].remote_date != date ]
+            if pool.limit.adaptive() and pool.limit.tasks_started > 0:
+                print("Settled on {} concurrent requests".format(pool.limit.current()))
+
+
+    def update_courses_concurrently(self, sync_courses, db_file_dict, concurrency):
+        with CourseListPool(concurrency, self) as pool:
+            for course in sync_courses:
+                pool.defer_course(course, db_file_dict)
+            pool.done()
 
-                if len(new_files) > 0:
-                    new_files_str = ("" if last_course_synced else "\n") + str(len(new_files))
-                    last_course_synced = True
-                else:
-                    new_files_str = "No"
-                    last_course_synced = False
+            # Each result holds everything about one course, so output stays grouped. Skipped
+            # courses have no result.
+            for result in pool:
+                if result is None:
+                    continue
+                course, new_files, updated_files, details, files = result
+                self.print_course_summary(course, new_files, updated_files)
+                self.store_course_files(course, files, new_files, details)
 
-                updated_files_str = ""
-                if len(updated_files) > 0:
-                    updated_files_str = ", {} updated ".format(len(updated_files))
 
-                print("{} new{} file(s) for {} {} ".format(new_files_str, updated_files_str,
-                        course.type, course.name))
+    def file_url(self, file):
+        return self.studip_url("/studip/sendfile.php?force_download=1&type=0&" \
+                + urlencode({"file_id": file.id, "file_name": file.name }))
 
-                files_to_fetch = new_files + updated_files
-                for file_id in files_to_fetch:
-                    pool.defer_request("GET", folder_url + "&open=" + file_id)
+
+    def probe_file_sizes(self, files):
+        """Asks the server for the sizes of files using HEAD requests. Files whose size is
+        unknown are missing from the returned dict."""
+        sizes = {}
+        concurrency = int(self.config["connection", "update_concurrency"])
+        max_concurrency = int(self.config["connection", "max_update_concurrency"])
+        try:
+            with self.request_pool(concurrency, max_concurrency) as pool:
+                for file in files:
+                    pool.defer_request("HEAD", self.file_url(file))
                 pool.done()
 
-                for i, request in enumerate(pool):
-                    try:
-                        file = parse_file_details(course.id, request.text)
-                    except ParserError:
-                        raise SessionError("Unable to parse file details")
-
-                    print("Fetched metadata for file {}/{}: ".format(i+1, len(files_to_fetch)),
-                            end="", flush=True)
-                    if file.complete():
-                        if file.id in new_files:
-                            self.db.add_file(file)
-                        else:
-                            self.db.update_file(file)
-                        print(" " + file.description)
-                    else:
-                        print(" <bad format>")
+                for r in pool:
+                    file_id = get_url_field(r.url, "file_id")
+                    length = r.headers.get("Content-Length", "")
+                    if r.status_code == 200 and file_id and length.isdigit():
+                        sizes[file_id] = int(length)
+        except (RequestException, SessionError) as e:
+            sys.stderr.write("Unable to determine all file sizes: {}\n".format(e))
+        return sizes
+
+
+    def schedule_fetches(self, pending_files, pending_offsets):
+        """Sorts the pending files into the order configured by connection/fetch_order."""
+        order = self.config["connection", "fetch_order"]
+        if order == "newest":
+            pending_files.sort(key=lambda p: p[0].remote_date or datetime.min, reverse=True)
+        elif order == "smallest":
+            # Partial downloads only need their remaining bytes, unknown sizes come last
+            sizes = self.probe_file_sizes(file for file, file_path, exists, update
+                    in pending_files)
+            pending_files.sort(key=lambda p: sizes.get(p[0].id, math.inf)
+                    - pending_offsets[p[0].id])
+        elif order == "semester":
+            semester_order = dict((s.name, s.order) for s in self.db.list_semesters())
+            pending_files.sort(key=lambda p: (semester_order.get(p[0].course_semester, -1),
+                    p[0].remote_date or datetime.min), reverse=True)
+        elif order != "none":
+            sys.stderr.write("Unknown fetch order \"{}\", fetching in database order\n".format(
+                    order))
+
+
+    def download_archive(self, course_id, files, archive_path, bucket):
+        """Downloads a ZIP archive of some files of a course, which Stud.IP creates on request."""
+        self.select_course(self.http, Course(course_id))
+        url = self.studip_url("/studip/folder.php?cid=" + course_id + "&cmd=all")
+        data = [ ("download_selected", "1") ] + [ ("download_ids[]", file.id) for file in files ]
+        r = self.request(self.http, "POST", url, data=data, stream=True)
+        try:
+            with open(archive_path, "wb") as writer:
+                for chunk in r.iter_content(FetchTasks.chunk_size):
+                    writer.write(chunk)
+                    if bucket:
+                        time.sleep(bucket.reserve(len(chunk)))
+        finally:
+            r.close()
+
+
+    def fetch_archives(self, pending_files, min_files, bucket):
+        """Fetches the pending files of every course with at least min_files of them through a
+        single ZIP archive instead of one request per file, yielding each file extracted from
+        it. Files that cannot be found in the archive are left to be downloaded separately."""
+        course_files = {}
+        for file, file_path in pending_files:
+            course_files.setdefault(file.course, []).append((file, file_path))
+
+        files_dir = path.join(self.sync_dir, ".studip", "files")
+        for course_id, files in course_files.items():
+            if len(files) < min_files:
+                continue
+
+            file_paths = dict((file.id, file_path) for file, file_path in files)
+            archive_path = path.join(files_dir, "." + course_id + ".zip.part")
+            try:
+                self.download_archive(course_id, [ file for file, _ in files ], archive_path,
+                        bucket)
+                with zipfile.ZipFile(archive_path) as archive:
+                    for file, info in match_archive_members(archive.infolist(),
+                            [ file for file, _ in files ]):
+                        # Reading a member to its end verifies its size and checksum
+                        part_path = partial_file_path(file_paths[file.id])
+                        try:
+                            with archive.open(info) as reader, \
+                                    open_partial_file(part_path, 0) as writer:
+                                shutil.copyfileobj(reader, writer, FetchTasks.chunk_size)
+                        except BaseException:
+                            # The member may fail to open before the file is created
+                            if path.isfile(part_path):
+                                os.unlink(part_path)
+                            raise
+
+                        finish_download(file, part_path, file_paths[file.id])
+                        yield file
+            except (RequestException, SessionError, zipfile.BadZipFile) as e:
+                sys.stderr.write("Unable to fetch archive of {}, fetching files separately: "
+                        "{}\n".format(files[0][0].course_name, e))
+            finally:
+                if path.isfile(archive_path):
+                    os.unlink(archive_path)
 
 
     def fetch_files(self):
-        first_file = True
         files_dir = path.join(self.sync_dir, ".studip", "files")
         os.makedirs(files_dir, exist_ok=True)
 
@@ -228,28 +1173,105 @@ class Session:
         pending_files = [(f, p, exists, update) for (f, p, exists, update) in sync_file_updates
                 if not exists or update]
 
-        for i, (file, file_path, exists, update) in enumerate(pending_files):
-            if first_file:
-                print()
-                first_file = False
-            print("Fetching file {}/{}: {}...".format(i+1, len(pending_files),
-                    ellipsize(file.description, 50)))
+        # Downloads finished by an interrupted fetch that did not get to commit them
+        reconciled_ids = set()
+        for file, file_path, exists, update in pending_files:
+            if exists and is_fetched(file, file_path):
+                file.local_date = file.remote_date
+                self.db.update_file_local_date(file)
+                self.db.remove_partial_fetch(file.id)
+                reconciled_ids.add(file.id)
+        pending_files = [ pending for pending in pending_files
+                if pending[0].id not in reconciled_ids ]
 
-            url = self.studip_url("/studip/sendfile.php?force_download=1&type=0&" \
-                    + urlencode({"file_id": file.id, "file_name": file.name }))
-            try:
-                r = self.http.get(url)
-            except RequestException as e:
-                raise SessionError("Unable to download file {}: {}".format(file.name, e))
+        # Partial downloads from an earlier run can be resumed if the file has not changed
+        # remotely in the meantime, all others are discarded
+        partial_fetches = self.db.list_partial_fetches()
+        pending_offsets = {}
+        for file, file_path, exists, update in pending_files:
+            part_path = partial_file_path(file_path)
+            offset = 0
+            if file.id in partial_fetches and path.isfile(part_path):
+                version, remote_date, bytes = partial_fetches[file.id]
+                size = path.getsize(part_path)
+                if version == file.version and remote_date == file.remote_date \
+                        and size >= bytes:
+                    offset = size
+            pending_offsets[file.id] = offset
+            self.db.add_partial_fetch(file, offset)
 
-            with open(file_path, "wb") as writer:
-                writer.write(r.content)
+        pending_ids = set(pending_offsets)
+        for file_id, (version, remote_date, bytes) in partial_fetches.items():
+            if file_id not in pending_ids:
+                part_path = partial_file_path(path.join(files_dir, file_id)
+                        + ("."  + str(version) if version > 0 else ""))
+                if path.isfile(part_path):
+                    os.unlink(part_path)
+                self.db.remove_partial_fetch(file_id)
+        self.db.commit()
 
-            file.local_date = file.remote_date
+        if not pending_files:
+            return
 
-            timestamp = time.mktime(file.local_date.timetuple())
-            os.utime(file_path, (timestamp, timestamp))
+        # Committing after every file would make the database the bottleneck for small files.
+        # Uncommitted files are recognized by is_fetched() should the fetch be interrupted.
+        commit_files = int(self.config["connection", "fetch_commit_files"])
+        commit_interval = float(self.config["connection", "fetch_commit_interval"])
+        fetched_files = []
+        uncommitted = 0
+        last_commit = time.monotonic()
+        def file_fetched(file, note):
+            nonlocal uncommitted, last_commit
+            if not fetched_files:
+                print()
+            fetched_files.append(file)
+            print("Fetched file {}/{}: {}{}".format(len(fetched_files), len(pending_files),
+                    ellipsize(file.description, 50), note))
 
             self.db.update_file_local_date(file)
-            self.db.commit()
+            self.db.remove_partial_fetch(file.id)
+            pending_ids.remove(file.id)
+            uncommitted += 1
+            if uncommitted >= commit_files or time.monotonic() - last_commit >= commit_interval:
+                self.db.commit()
+                uncommitted = 0
+                last_commit = time.monotonic()
 
+        bandwidth = int(self.config["connection", "fetch_bandwidth"])
+        bucket = TokenBucket(bandwidth) if bandwidth > 0 else None
+        try:
+            # Downloads that can be resumed are better off without an archive
+            zip_min_files = int(self.config["connection", "zip_min_files"])
+            if zip_min_files > 0:
+                archive_files = [ (file, file_path) for file, file_path, exists, update
+                        in pending_files if pending_offsets[file.id] == 0 ]
+                for file in self.fetch_archives(archive_files, zip_min_files, bucket):
+                    file_fetched(file, " (from archive)")
+
+            remaining_files = [ pending for pending in pending_files
+                    if pending[0].id in pending_ids ]
+            if not remaining_files:
+                return
+
+            # The pool starts downloads in the order they are deferred in
+            self.schedule_fetches(remaining_files, pending_offsets)
+
+            concurrency = min(int(self.config["connection", "fetch_concurrency"]),
+                    len(remaining_files))
+            with self.fetch_pool(concurrency, bucket) as pool:
+                for file, file_path, exists, update in remaining_files:
+                    pool.defer_fetch(file, file_path, self.file_url(file),
+                            pending_offsets[file.id])
+                pool.done()
+
+                # Results arrive in order of completion, the counter keeps the output sequential
+                for file, offset in pool:
+                    file_fetched(file, " (resumed)" if offset > 0 else "")
+        finally:
+            # Record how far each interrupted download got
+            for file, file_path, exists, update in pending_files:
+                if file.id in pending_ids:
+                    part_path = partial_file_path(file_path)
+                    if path.isfile(part_path):
+                        self.db.update_partial_fetch(file.id, path.getsize(part_path))
+            self.db.commit()
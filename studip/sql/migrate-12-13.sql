@@ -0,0 +1,18 @@
+BEGIN TRANSACTION;
+
+CREATE TABLE fetch_journal (
+    file CHAR(32) NOT NULL,
+    version INTEGER NOT NULL,
+    remote_date TIMESTAMP,
+    bytes INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (file ASC),
+    FOREIGN KEY (file) REFERENCES files(id)
+) WITHOUT ROWID;
+
+CREATE TRIGGER cleanup_fetch_journal_files
+BEFORE DELETE ON files
+BEGIN
+    DELETE FROM fetch_journal WHERE file = old.id;
+END;
+
+END TRANSACTION;
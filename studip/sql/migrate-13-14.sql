@@ -0,0 +1,16 @@
+BEGIN TRANSACTION;
+
+CREATE TABLE update_checkpoints (
+    course CHAR(32) NOT NULL,
+    time TIMESTAMP NOT NULL,
+    PRIMARY KEY (course ASC),
+    FOREIGN KEY (course) REFERENCES courses(id)
+) WITHOUT ROWID;
+
+CREATE TRIGGER cleanup_update_checkpoints_courses
+BEFORE DELETE ON courses
+BEGIN
+    DELETE FROM update_checkpoints WHERE course = old.id;
+END;
+
+END TRANSACTION;
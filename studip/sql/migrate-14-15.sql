@@ -0,0 +1,89 @@
+BEGIN TRANSACTION;
+
+DROP VIEW file_details;
+DROP VIEW folder_paths;
+DROP VIEW IF EXISTS folder_parents;
+DROP TRIGGER create_root_folder;
+
+ALTER TABLE folders ADD COLUMN path VARCHAR(1024);
+ALTER TABLE folders ADD COLUMN course CHAR(32) REFERENCES courses(id);
+
+CREATE TEMPORARY TABLE folder_tree (
+    id INTEGER NOT NULL,
+    path VARCHAR(1024),
+    course CHAR(32),
+    PRIMARY KEY (id ASC)
+);
+
+INSERT INTO folder_tree (id, path, course)
+    WITH RECURSIVE tree (id, path, course) AS (
+        SELECT folders.id, '', courses.id
+            FROM folders
+            LEFT OUTER JOIN courses ON courses.root = folders.id
+            WHERE folders.parent IS NULL
+        UNION ALL
+        SELECT folders.id, CASE WHEN tree.path = '' THEN folders.name
+                ELSE tree.path || char(31) || folders.name END, tree.course
+            FROM folders
+            INNER JOIN tree ON folders.parent = tree.id
+    )
+    SELECT id, path, course FROM tree;
+
+UPDATE folders
+SET path = (SELECT path FROM folder_tree WHERE folder_tree.id = folders.id),
+    course = (SELECT course FROM folder_tree WHERE folder_tree.id = folders.id);
+
+DROP TABLE folder_tree;
+
+CREATE TRIGGER create_root_folder
+AFTER INSERT ON courses WHEN new.root IS NULL
+BEGIN
+    INSERT INTO folders (parent, path, course) VALUES (NULL, '', new.id);
+    UPDATE courses SET root = last_insert_rowid() WHERE id = new.id;
+END;
+
+CREATE TRIGGER materialize_folder_path
+AFTER INSERT ON folders WHEN new.parent IS NOT NULL
+BEGIN
+    UPDATE folders
+    SET path = (
+            SELECT CASE WHEN p.path = '' THEN new.name ELSE p.path || char(31) || new.name END
+            FROM folders AS p
+            WHERE p.id = new.parent
+        ),
+        course = (SELECT course FROM folders WHERE id = new.parent)
+    WHERE id = new.id;
+END;
+
+CREATE TRIGGER rematerialize_folder_paths
+AFTER UPDATE OF name, parent ON folders WHEN new.parent IS NOT NULL
+BEGIN
+    UPDATE folders
+    SET path = (
+            SELECT CASE WHEN p.path = '' THEN new.name ELSE p.path || char(31) || new.name END
+            FROM folders AS p
+            WHERE p.id = new.parent
+        ),
+        course = (SELECT course FROM folders WHERE id = new.parent)
+    WHERE id = new.id;
+    -- Subfolders keep the part of their path below the moved or renamed folder
+    UPDATE folders
+    SET path = (SELECT path FROM folders WHERE id = new.id)
+            || substr(path, length(old.path) + 1),
+        course = (SELECT course FROM folders WHERE id = new.id)
+    WHERE course IS old.course AND substr(path, 1, length(old.path) + 1) = old.path || char(31);
+END;
+
+CREATE VIEW file_details AS
+    SELECT f.id AS id, c.id AS course_id, s.name AS course_semester, c.name AS course_name,
+            c.abbrev AS course_abbrev, c.type AS course_type, c.type_abbrev as course_type_abbrev,
+            p.path AS path, f.name AS name, f.extension AS extension,
+            f.author AS author, f.description AS description, f.remote_date AS remote_date,
+            f.copyrighted AS copyrighted, f.local_date as local_date, f.version AS version,
+            c.sync AS sync
+    FROM files AS f
+    INNER JOIN folders AS p ON f.folder = p.id
+    INNER JOIN courses AS c ON p.course = c.id
+    INNER JOIN semesters AS s ON c.semester = s.id;
+
+END TRANSACTION;
@@ -0,0 +1,5 @@
+BEGIN TRANSACTION;
+
+CREATE INDEX folder_names ON folders (parent, name);
+
+END TRANSACTION;
@@ -0,0 +1,5 @@
+BEGIN TRANSACTION;
+
+CREATE INDEX folder_courses ON folders (course);
+
+END TRANSACTION;
@@ -47,23 +47,63 @@ CREATE TABLE IF NOT EXISTS files (
     FOREIGN KEY (folder) REFERENCES folders(id)
 ) WITHOUT ROWID;
 
+-- path holds the names of all folders from the course root down to this one, separated by the
+-- unit separator char(31). It is the empty string for the root folder itself. Both path and course
+-- are maintained by the triggers below.
 CREATE TABLE IF NOT EXISTS folders (
     id INTEGER NOT NULL,
     name VARCHAR(128),
     parent INTEGER,
+    path VARCHAR(1024),
+    course CHAR(32),
     PRIMARY KEY (id ASC),
     FOREIGN KEY (parent) REFERENCES folders(id),
+    FOREIGN KEY (course) REFERENCES courses(id),
     CHECK ((name IS NULL) == (parent IS NULL))
 );
 
+CREATE INDEX IF NOT EXISTS folder_names ON folders (parent, name);
+CREATE INDEX IF NOT EXISTS folder_courses ON folders (course);
+
 CREATE TRIGGER IF NOT EXISTS create_root_folder
 AFTER INSERT ON courses WHEN new.root IS NULL
 BEGIN
-    -- INSERT INTO ... DEFAULT VALUES is not supported inside triggers
-    INSERT INTO folders (parent) VALUES (NULL);
+    INSERT INTO folders (parent, path, course) VALUES (NULL, '', new.id);
     UPDATE courses SET root = last_insert_rowid() WHERE id = new.id;
 END;
 
+CREATE TRIGGER IF NOT EXISTS materialize_folder_path
+AFTER INSERT ON folders WHEN new.parent IS NOT NULL
+BEGIN
+    UPDATE folders
+    SET path = (
+            SELECT CASE WHEN p.path = '' THEN new.name ELSE p.path || char(31) || new.name END
+            FROM folders AS p
+            WHERE p.id = new.parent
+        ),
+        course = (SELECT course FROM folders WHERE id = new.parent)
+    WHERE id = new.id;
+END;
+
+CREATE TRIGGER IF NOT EXISTS rematerialize_folder_paths
+AFTER UPDATE OF name, parent ON folders WHEN new.parent IS NOT NULL
+BEGIN
+    UPDATE folders
+    SET path = (
+            SELECT CASE WHEN p.path = '' THEN new.name ELSE p.path || char(31) || new.name END
+            FROM folders AS p
+            WHERE p.id = new.parent
+        ),
+        course = (SELECT course FROM folders WHERE id = new.parent)
+    WHERE id = new.id;
+    -- Subfolders keep the part of their path below the moved or renamed folder
+    UPDATE folders
+    SET path = (SELECT path FROM folders WHERE id = new.id)
+            || substr(path, length(old.path) + 1),
+        course = (SELECT course FROM folders WHERE id = new.id)
+    WHERE course IS old.course AND substr(path, 1, length(old.path) + 1) = old.path || char(31);
+END;
+
 CREATE TABLE IF NOT EXISTS checkouts (
     view INTEGER NOT NULL,
     file id CHAR(32) NOT NULL,
@@ -84,30 +124,33 @@ BEGIN
     DELETE FROM checkouts WHERE file = old.id;
 END;
 
-CREATE VIEW IF NOT EXISTS folder_parents AS
-    WITH RECURSIVE parents (folder, level, this, parent) AS (
-        SELECT id, 0, id, parent
-            FROM folders
-        UNION ALL
-        SELECT parents.folder, parents.level + 1, folders.id, folders.parent
-            FROM folders
-            INNER JOIN parents ON folders.id = parents.parent
-    )
-    SELECT folder, level, this FROM parents;
-
-CREATE VIEW IF NOT EXISTS folder_paths AS
-    SELECT list.folder AS folder,
-        MAX(courses.id) AS course,
-        '[' || IFNULL(GROUP_CONCAT('"' || REPLACE(REPLACE(folders.name, '\', '\\'),
-            '"', '\"') || '"', ', '), '') || ']' AS path
-    FROM (
-        SELECT parents.folder AS folder, parents.this AS this
-        FROM folder_parents AS parents
-        ORDER BY level DESC
-    ) AS list
-    INNER JOIN folders ON folders.id = list.this
-    LEFT OUTER JOIN courses ON courses.root = folders.id
-    GROUP BY folder;
+CREATE TABLE IF NOT EXISTS fetch_journal (
+    file CHAR(32) NOT NULL,
+    version INTEGER NOT NULL,
+    remote_date TIMESTAMP,
+    bytes INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (file ASC),
+    FOREIGN KEY (file) REFERENCES files(id)
+) WITHOUT ROWID;
+
+CREATE TRIGGER IF NOT EXISTS cleanup_fetch_journal_files
+BEFORE DELETE ON files
+BEGIN
+    DELETE FROM fetch_journal WHERE file = old.id;
+END;
+
+CREATE TABLE IF NOT EXISTS update_checkpoints (
+    course CHAR(32) NOT NULL,
+    time TIMESTAMP NOT NULL,
+    PRIMARY KEY (course ASC),
+    FOREIGN KEY (course) REFERENCES courses(id)
+) WITHOUT ROWID;
+
+CREATE TRIGGER IF NOT EXISTS cleanup_update_checkpoints_courses
+BEFORE DELETE ON courses
+BEGIN
+    DELETE FROM update_checkpoints WHERE course = old.id;
+END;
 
 CREATE VIEW IF NOT EXISTS file_details AS
     SELECT f.id AS id, c.id AS course_id, s.name AS course_semester, c.name AS course_name,
@@ -117,7 +160,7 @@ CREATE VIEW IF NOT EXISTS file_details AS
             f.copyrighted AS copyrighted, f.local_date as local_date, f.version AS version,
             c.sync AS sync
     FROM files AS f
-    INNER JOIN folder_paths AS p ON f.folder = p.folder
+    INNER JOIN folders AS p ON f.folder = p.id
     INNER JOIN courses AS c ON p.course = c.id
     INNER JOIN semesters AS s ON c.semester = s.id;
 
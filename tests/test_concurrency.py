@@ -0,0 +1,157 @@
+import asyncio, time, threading, pytest
+
+from studip.concurrency import ThreadPool, AsyncPool, RetryPolicy, ExitThread
+
+
+class FunctionPool(ThreadPool):
+    """Executes tasks that are functions."""
+
+    def execute_task(self, local_state, task):
+        return task()
+
+
+def run_in_thread(function):
+    thread = threading.Thread(target=function, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_defer_blocks_while_queue_is_full():
+    started, release = threading.Event(), threading.Event()
+
+    def blocking_task():
+        started.set()
+        release.wait(10)
+        return "blocking"
+
+    with FunctionPool(1, max_queued=2) as pool:
+        pool.defer(blocking_task)
+        assert started.wait(10)
+        pool.defer(lambda: 1)
+        pool.defer(lambda: 2)
+
+        # The worker is busy and two tasks are queued, so the next one has to wait
+        producer = run_in_thread(lambda: pool.defer(lambda: 3))
+        producer.join(0.2)
+        assert producer.is_alive()
+
+        release.set()
+        producer.join(10)
+        assert not producer.is_alive()
+        pool.done()
+        assert sorted(map(str, pool)) == [ "1", "2", "3", "blocking" ]
+
+
+def test_ordered_results_skip_failed_task():
+    def slow():
+        time.sleep(0.2)
+        return 0
+
+    def fail():
+        raise ValueError("failed")
+
+    with FunctionPool(3, ordered=True) as pool:
+        for task in [ slow, fail, lambda: 2, lambda: 3 ]:
+            pool.defer(task)
+        pool.done()
+
+        # The failure is reported as soon as it happens, the other results keep their order
+        results = []
+        with pytest.raises(ValueError):
+            for result in pool:
+                results.append(result)
+        results += list(pool)
+        assert results == [ 0, 2, 3 ]
+
+
+def test_destroy_during_long_task():
+    started = threading.Event()
+    cooperative_exit = threading.Event()
+
+    class LongTaskPool(ThreadPool):
+        join_timeout = 0.5
+
+        def execute_task(self, local_state, task):
+            started.set()
+            if task == "cooperative":
+                while not self.cancelled.wait(0.01):
+                    pass
+                cooperative_exit.set()
+                raise ExitThread()
+            # Stands in for a network operation that does not notice the cancellation
+            time.sleep(30)
+
+    for task in [ "cooperative", "blocking" ]:
+        started.clear()
+        pool = LongTaskPool(1)
+        pool.defer(task)
+        assert started.wait(10)
+        start = time.perf_counter()
+        pool.destroy()
+        assert time.perf_counter() - start < 5
+    assert cooperative_exit.is_set()
+
+
+class CountingAsyncPool(AsyncPool):
+    """Returns every task after yielding to the loop, tracking how many run at once."""
+
+    def __init__(self, *args, **kwargs):
+        self.running = 0
+        self.max_running = 0
+        super().__init__(*args, **kwargs)
+
+    async def execute_task(self, task):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            await asyncio.sleep(0)
+            return task
+        finally:
+            self.running -= 1
+
+
+class FlakyAsyncPool(AsyncPool):
+    """Fails the first attempts at every task with a retryable error."""
+
+    def __init__(self, failures, *args, **kwargs):
+        self.failures = failures
+        self.attempts = {}
+        super().__init__(*args, **kwargs)
+
+    async def execute_task(self, task):
+        self.attempts[task] = self.attempts.get(task, 0) + 1
+        if self.attempts[task] <= self.failures:
+            raise ValueError(task)
+        return task
+
+    def is_retryable(self, result, exception):
+        return isinstance(exception, ValueError)
+
+
+def test_async_pool_respects_slots():
+    with CountingAsyncPool(8) as pool:
+        for i in range(1000):
+            pool.defer(i)
+        pool.done()
+        assert sorted(pool) == list(range(1000))
+        assert pool.max_running == 8
+
+
+def test_async_pool_scales_with_tasks():
+    # Every finished task used to wake all waiting ones, which took seconds for this many
+    start = time.perf_counter()
+    with CountingAsyncPool(8) as pool:
+        for i in range(8000):
+            pool.defer(i)
+        pool.done()
+        assert len(list(pool)) == 8000
+    assert time.perf_counter() - start < 5
+
+
+def test_async_pool_ordered_retries():
+    with FlakyAsyncPool(2, 4, retry=RetryPolicy(retries=2, delay=0.001), ordered=True) as pool:
+        for i in range(20):
+            pool.defer(i)
+        pool.done()
+        assert list(pool) == list(range(20))
+        assert all(n == 3 for n in pool.attempts.values())
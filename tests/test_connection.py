@@ -0,0 +1,83 @@
+import os, json, time, threading, pytest
+
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from requests import ConnectionError, Timeout
+
+from studip.connection import create_session, share_session, RecordingAdapter, ReplayAdapter
+
+
+class LowerCaseHeaderHandler(BaseHTTPRequestHandler):
+    """Answers with header names in lower case, as HTTP/2 servers and some proxies do."""
+
+    def do_GET(self):
+        body = b"<html></html>"
+        self.send_response(200)
+        self.send_header("set-cookie", "Seminar_Session=secret; Path=/")
+        self.send_header("content-length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def test_recording_scrubs_lower_case_headers(tmp_path):
+    server = HTTPServer(("127.0.0.1", 0), LowerCaseHeaderHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        adapter = RecordingAdapter(str(tmp_path))
+        http = create_session(1, adapter=adapter)
+        url = "http://127.0.0.1:{}/".format(server.server_address[1])
+        r = http.get(url, headers={ "cookie": "Seminar_Session=secret" })
+        assert r.status_code == 200
+        adapter.close()
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    with open(os.path.join(str(tmp_path), "exchanges.jsonl"), "r") as file:
+        exchange = json.loads(file.readline())
+    assert "secret" not in json.dumps(exchange)
+    assert not any(k.lower() == "set-cookie" for k in exchange["headers"])
+    assert not any(k.lower() == "cookie" for k in exchange["request_headers"])
+
+    # The recorded length is replaced by the length of the stored body, whatever its case
+    replay = create_session(1, adapter=ReplayAdapter(str(tmp_path), latency_scale=0))
+    r = replay.get(url)
+    assert r.content == b"<html></html>"
+    assert [ k for k in r.headers if k.lower() == "content-length" ] == [ "Content-Length" ]
+
+
+class StallingHandler(BaseHTTPRequestHandler):
+    """Sends the start of a body and then nothing until the server's resume event is set."""
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write(b"x")
+        self.wfile.flush()
+        self.server.resume.wait(10)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def test_shared_session_times_out_on_stalled_body():
+    server = HTTPServer(("127.0.0.1", 0), StallingHandler)
+    server.resume = threading.Event()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        http = share_session(create_session(1, timeout=0.2))
+        url = "http://127.0.0.1:{}/".format(server.server_address[1])
+        start = time.perf_counter()
+        # Newer versions of requests report read timeouts as a ConnectionError
+        with pytest.raises((Timeout, ConnectionError)):
+            http.get(url, stream=True).content
+        assert time.perf_counter() - start < 5
+    finally:
+        server.resume.set()
+        server.shutdown()
+        server.server_close()
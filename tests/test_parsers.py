@@ -0,0 +1,69 @@
+import pytest
+
+from datetime import datetime
+
+from studip.parsers import ParserError, parse_file_list, parse_file_listing
+
+
+COURSE_ID = "0" * 32
+
+EXPANDED_FILE = """
+<div id="file_abc_0">
+<table><tr><td><span id="file_abc_header" style="font-weight: bold">Slides 1</span></td>
+<td><a href="/studip/dispatch.php/profile?username=lecturer">Lecturer</a> 01.02.2020 - 10:00</td>
+</tr></table>
+<div id="file_abc_body">
+<a href="/studip/folder.php?cid=c&amp;open=f#anker">Allgemeiner Dateiordner / Slides</a>
+<a href="/studip/sendfile.php?type=0&amp;file_id=abc&amp;file_name=slides_1.pdf">slides_1.pdf</a>
+</div>
+</div>
+"""
+
+COLLAPSED_FILE = """
+<div id="file_def_0">
+<table><tr><td><span id="file_def_header">Slides 2</span>
+<a href="/studip/sendfile.php?type=0&amp;file_id=def&amp;file_name=slides_2.pdf">download</a></td>
+<td><a href="/studip/dispatch.php/profile?username=lecturer">Lecturer</a> 08.02.2020 - 10:00</td>
+</tr></table>
+</div>
+"""
+
+ERROR_BOX = """
+<div class="messagebox messagebox_error"><div class="messagebox_buttons"><a>x</a></div>
+Keine Veranstaltung ausgewählt.</div>
+"""
+
+
+def page(content):
+    return "<html><body><div id=\"folders\">{}</div></body></html>".format(content)
+
+
+def test_file_listing_lists_collapsed_files():
+    html = page(EXPANDED_FILE + COLLAPSED_FILE)
+    file_list, details = parse_file_listing(COURSE_ID, html)
+
+    assert file_list == [ ("abc", datetime(2020, 2, 1, 10, 0)),
+            ("def", datetime(2020, 2, 8, 10, 0)) ]
+    assert file_list == parse_file_list(html)
+
+    # Only the expanded file is described completely, the other one needs its details fetched
+    assert list(details) == [ "abc" ]
+    file = details["abc"]
+    assert (file.course, file.name, file.extension, file.description, file.author) \
+            == (COURSE_ID, "slides_1", "pdf", "Slides 1", "Lecturer")
+    assert file.path == [ "Allgemeiner Dateiordner", "Slides" ]
+    assert file.remote_date == datetime(2020, 2, 1, 10, 0)
+
+
+def test_file_listing_of_collapsed_files_only():
+    file_list, details = parse_file_listing(COURSE_ID, page(COLLAPSED_FILE))
+    assert file_list == [ ("def", datetime(2020, 2, 8, 10, 0)) ]
+    assert details == {}
+
+
+@pytest.mark.parametrize("parser", [ parse_file_list,
+        lambda html: parse_file_listing(COURSE_ID, html) ])
+def test_file_list_error(parser):
+    with pytest.raises(ParserError) as info:
+        parser(page(ERROR_BOX))
+    assert info.value.message == "x Keine Veranstaltung ausgewählt."
@@ -0,0 +1,64 @@
+import os, pytest
+
+from benchmarks.sync import SyncBenchmark
+from studip.mockserver import MockServer, MockAccount
+
+
+def engine_params():
+    try:
+        import aiohttp
+    except ImportError:
+        return [ "threads", pytest.param("asyncio", marks=pytest.mark.skip(
+                reason="aiohttp is not installed")) ]
+    return [ "threads", "asyncio" ]
+
+
+def assert_fetched(account, sync_dir):
+    files_dir = os.path.join(sync_dir, ".studip", "files")
+    fetched = [ name for name in os.listdir(files_dir) if not name.startswith(".") ]
+    assert sorted(fetched) == sorted(account.files)
+    for file_id, file in account.files.items():
+        with open(os.path.join(files_dir, file_id), "rb") as local_file:
+            assert local_file.read() == b"".join(file.content())
+
+
+def sync(account, engine, failure_rate=0, parse_processes=0):
+    """Runs update and fetch against a stand-in server and returns the number of requests it
+    rejected during each."""
+    config = {
+        ("connection", "engine"): engine,
+        ("connection", "retries"): 8,
+        ("connection", "retry_delay"): 0.01,
+        ("connection", "parse_processes"): parse_processes,
+    }
+    rejected = []
+    with MockServer(account, failure_rate=failure_rate) as server:
+        benchmark = SyncBenchmark(server, account, config)
+        try:
+            for phase in [ "update", "fetch" ]:
+                benchmark.run_phase(phase)
+                rejected.append(server.state.stats()["requests"].get("rejected", 0))
+            assert_fetched(account, benchmark.sync_dir)
+        finally:
+            benchmark.remove()
+    return rejected
+
+
+@pytest.mark.parametrize("engine", engine_params())
+def test_update_and_fetch(engine):
+    account = MockAccount(courses=3, files=8, folders=2, depth=1, file_size=20 * 1024)
+    assert sync(account, engine) == [ 0, 0 ]
+
+
+@pytest.mark.parametrize("engine", engine_params())
+def test_update_and_fetch_retry_rejected_requests(engine):
+    account = MockAccount(courses=6, files=6, folders=2, depth=1, file_size=20 * 1024)
+    rejected = sync(account, engine, failure_rate=0.3)
+    assert all(n > 0 for n in rejected)
+
+
+def test_update_with_parse_processes():
+    # Some files are collapsed in the listings, so their details are parsed by the processes
+    account = MockAccount(courses=3, files=12, folders=2, depth=1, file_size=1024)
+    assert any(f.collapsed for f in account.files.values())
+    assert sync(account, "threads", parse_processes=2) == [ 0, 0 ]